@@ -5,6 +5,7 @@ matplotlib.use('svg')
 
 import numpy as np
 import time
+import calendar
 from datetime import datetime, timedelta
 from datetime import time as dt_time
 import gettext
@@ -12,18 +13,24 @@ import pytz
 from isoweek import Week  # Sort-of necessary until datetime supports %V, see http://bugs.python.org/issue12006
                           # and See http://stackoverflow.com/questions/5882405/get-date-from-iso-week-number-in-python
 import re
-import sqlite3
+import json
+import hashlib
 import yaml
 from odict import odict
 import urllib
 import argparse
 import codecs
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import mwclient
 from mwtemplates import TemplateEditor
-from mwtextextractor import get_body_text
 import ukcommon
 from ukcommon import log, init_localization
+from ukhttp import ConnectionPool, RecordingPool, ReplayPool, Cassette, Clock
+import ukdb
+import ukfeatures
 
 import locale
 
@@ -43,8 +50,16 @@ parser.add_argument('--log', nargs='?', default='', help='Log file')
 parser.add_argument('--verbose', action='store_true', default=False, help='More verbose logging')
 parser.add_argument('--close', action='store_true', help='Close contest')
 parser.add_argument('--config', nargs='?', default='config.yml', help='Config file')
+parser.add_argument('--record', metavar='DIR', help='Record all API responses to DIR, which must not hold an earlier recording')
+parser.add_argument('--replay', metavar='DIR', help='Replay API responses recorded to DIR, without network access. '
+                    + 'Implies --simulate. Use with a copy of the DB as it was when recording.')
 args = parser.parse_args()
 
+if args.record and args.replay:
+    parser.error('--record and --replay can not be combined')
+if args.replay:
+    args.simulate = True
+
 if args.log != '':
     ukcommon.logfile = open(args.log, 'a')
 
@@ -54,7 +69,9 @@ server_tz = pytz.timezone(config['server_timezone'])
 
 t, _ = init_localization(config['locale'])
 
-runstart = server_tz.localize(datetime.now())
+# All times of the run are read from the clock, so that a replay sees the time of the recording
+clock = Clock(args.record, args.replay)
+runstart = server_tz.localize(clock.now())
 log('-----------------------------------------------------------------')
 log('UKBot starting at %s (server time), %s (wiki time)' % (runstart.strftime('%F %T'), runstart.astimezone(wiki_tz).strftime('%F %T')))
 
@@ -106,13 +123,73 @@ class Site(mwclient.Site):
         self.name = host
         self.key = host.split('.')[0]
         log('@ Initializing site: %s' % host)
-        mwclient.Site.__init__(self, host, clients_useragent='UKBot [[:no:Bruker:UKBot]]')
+        useragent = 'UKBot [[:no:Bruker:UKBot]]'
+        if args.record:
+            pool = RecordingPool(Cassette(args.record, host), useragent, **config.get('http', {}))
+        elif args.replay:
+            pool = ReplayPool(Cassette(args.replay, host), useragent, **config.get('http', {}))
+        else:
+            pool = ConnectionPool(useragent, **config.get('http', {}))
+        mwclient.Site.__init__(self, host, clients_useragent=useragent, pool=pool)
         # Login to increase api limit from 50 to 500
         self.login(username, password)
 
 
+class PointTotals(object):
+    """
+    Running totals of the points given to the revisions of an article, for each point type
+    and for all types (''). The points of each revision are summed first, and then added to
+    the points of the revisions before it, so the totals are exactly the same as summing
+    Revision.get_points over the revisions.
+    """
+
+    def __init__(self):
+        self.totals = {}   # (ptype, ignore_max) -> [points of the earlier revisions, points of the current revision]
+        self.revid = None
+
+    def add(self, revid, ptype, points, raw):
+        if revid != self.revid:
+            for t in self.totals.itervalues():
+                t[0] += t[1]
+                t[1] = 0.
+            self.revid = revid
+        for key, value in (((ptype, False), points), ((ptype, True), raw), (('', False), points), (('', True), raw)):
+            if not key in self.totals:
+                self.totals[key] = [0., 0.]
+            self.totals[key][1] += value
+
+    def get(self, ptype='', ignore_max=False):
+        t = self.totals.get((ptype, ignore_max))
+        if t is None:
+            return 0.
+        return t[0] + t[1]
+
+
+class Timeline(object):
+    """
+    The points given to a user over time, as arrays in order of time: for each revision
+    giving points, the time (Unix time), the points given and the total points so far.
+    """
+
+    def __init__(self, timestamps, points):
+        """ Takes revision timestamps (Unix times) and their points """
+        t = np.array(timestamps, dtype=float)
+        o = np.argsort(t, kind='mergesort')
+        self.time = t[o]
+        self.points = np.array(points, dtype=float)[o]
+        self.total = np.cumsum(self.points)
+
+    def __len__(self):
+        return len(self.time)
+
+
 class Article(object):
 
+    # A contest can have many articles and revisions, so they are kept without a __dict__.
+    # cat_path is only set by CatFilter.
+    __slots__ = ('site', 'user', 'name', 'disqualified', 'revisions', 'point_deductions',
+                 'errors', 'totals', 'totals_all', 'cat_path')
+
     def __init__(self, site, user, name):
         """
         An article is uniquely identified by its name and its site
@@ -128,6 +205,10 @@ class Article(object):
         #self.redirect = False
         self.errors = []
 
+        # Updated by Revision.add_points
+        self.totals = PointTotals()       # revisions made before the user was suspended
+        self.totals_all = PointTotals()   # all revisions
+
         key = self.site.key + ':' + self.name
         for pd in self.user.point_deductions:
             if pd[0] == key:
@@ -152,8 +233,10 @@ class Article(object):
         return firstrev.new and not firstrev.redirect
 
     def add_revision(self, revid, **kwargs):
-        self.revisions[revid] = Revision(self, revid, **kwargs)
-        return self.revisions[revid]
+        rev = Revision(self, revid, **kwargs)
+        self.revisions[revid] = rev
+        self.user.index_revision(rev)
+        return rev
 
     def add_point_deduction(self, points, reason):
         log('Adding point deduction %d points for reason: %s' % (points, reason))
@@ -173,18 +256,39 @@ class Article(object):
         return self.get_points()
         #return np.sum([rev.get_points() for rev in self.revisions.values()])
 
+    def get_fingerprint(self):
+        """
+        Identifies the rules and the state of the article that the points given to
+        its revisions depend on, see User.analyze
+        """
+        article_key = self.site.key + ':' + self.name
+        state = [self.user.contest.rules_fingerprint, self.user.suspended_ts,
+                 article_key in self.user.disqualified_articles, self.point_deductions]
+        return hashlib.sha1(json.dumps(state)).hexdigest()
+
+    def reset_points(self):
+        self.totals = PointTotals()
+        self.totals_all = PointTotals()
+        for rev in self.revisions.itervalues():
+            rev.points = []
+
+    def count_points(self, rev, ptype, points, raw):
+        """ Adds points given to one of the article's revisions to the running totals """
+        self.totals_all.add(rev.revid, ptype, points, raw)
+        if self.user.suspended_ts is None or rev.timestamp < self.user.suspended_ts:
+            self.totals.add(rev.revid, ptype, points, raw)
+        elif self.user.contest.verbose:
+            log('!! Skipping revision %d in suspension period' % rev.revid)
+
     def get_points(self, ptype='', ignore_max=False, ignore_suspension_period=False,
                    ignore_disqualification=False, ignore_point_deductions=False):
         p = 0.
         article_key = self.site.key + ':' + self.name
         if ignore_disqualification or not article_key in self.user.disqualified_articles:
-            for revid, rev in self.revisions.iteritems():
-                dt = pytz.utc.localize(datetime.fromtimestamp(rev.timestamp))
-                if ignore_suspension_period is True or self.user.suspended_since is None or dt < self.user.suspended_since:
-                    p += rev.get_points(ptype, ignore_max)
-                else:
-                    if self.user.contest.verbose:
-                        log('!! Skipping revision %d in suspension period' % revid)
+            if ignore_suspension_period:
+                p = self.totals_all.get(ptype, ignore_max)
+            else:
+                p = self.totals.get(ptype, ignore_max)
 
         if ptype == '' and not ignore_point_deductions:
             for points, reason in self.point_deductions:
@@ -195,6 +299,9 @@ class Article(object):
 
 class Revision(object):
 
+    __slots__ = ('article', 'errors', 'revid', 'timestamp', 'size', 'texthash', 'parentid',
+                 'parentsize', 'parenthash', 'points', 'dirty')
+
     def __init__(self, article, revid, **kwargs):
         """
         A revision is uniquely identified by its revision id and its site
@@ -208,13 +315,17 @@ class Revision(object):
 
         self.revid = revid
         self.size = -1
-        self.text = ''
+        self.texthash = None      # key of the text in UK.texts
 
         self.parentid = 0
         self.parentsize = 0
-        self.parenttext = ''
+        self.parenthash = None
+
+        self.points = []   # tuples of (points, ptype, txt) or (points, ptype, txt, raw), see add_points
 
-        self.points = []
+        # True until the revision has been written to the DB by User.save_contribs_to_db.
+        # Must be set again whenever data that is stored in the DB changes.
+        self.dirty = True
 
         for k, v in kwargs.iteritems():
             if k == 'timestamp':
@@ -231,27 +342,60 @@ class Revision(object):
     def __repr__(self):
         return ("<Revision %d for %s:%s>" % (self.revid, self.site.key, self.article.name)).encode('utf-8')
 
+    @property
+    def texts(self):
+        return self.article.user.contest.texts
+
+    @property
+    def text(self):
+        if self.texthash is None:
+            return ''
+        return self.texts.get(self.texthash)
+
+    @text.setter
+    def text(self, value):
+        if len(value) == 0:
+            self.texthash = None
+        else:
+            self.texthash = self.texts.add(value)
+
+    @property
+    def parenttext(self):
+        if self.parenthash is None:
+            return ''
+        return self.texts.get(self.parenthash)
+
+    @parenttext.setter
+    def parenttext(self, value):
+        if len(value) == 0:
+            self.parenthash = None
+        else:
+            self.parenthash = self.texts.add(value)
+
+    @property
+    def has_text(self):
+        """ True if we have the text, without decompressing it """
+        return self.texthash is not None
+
+    @property
+    def has_parenttext(self):
+        return self.parenthash is not None
+
     @property
     def bytes(self):
         return self.size - self.parentsize
 
+    def feature(self, name):
+        """ Returns a count derived from the text, see ukfeatures. Counted by comparing with the parent text if possible. """
+        return self.article.user.contest.features.get(self.texthash, name, self.parenthash)
+
+    def parentfeature(self, name):
+        """ Returns a count derived from the parent text, see ukfeatures """
+        return self.article.user.contest.features.get(self.parenthash, name)
+
     @property
     def words(self):
-        try:
-            return self._wordcount
-        except:
-            mt1 = get_body_text(self.text)
-            mt2 = get_body_text(self.parenttext)
-            self._wordcount = len(mt1.split()) - len(mt2.split())
-            s = _('A problem encountered with revision %(revid)d may have influenced the word count for this revision: <nowiki>%(problems)s</nowiki> ')
-            #s = _('Et problem med revisjon %d kan ha påvirket ordtellingen for denne: <nowiki>%s</nowiki> ')
-            del mt1
-            del mt2
-            # except DanmicholoParseError as e:
-            #     log("!!!>> FAIL: %s @ %d" % (self.article.name, self.revid))
-            #     self._wordcount = 0
-            #     #raise
-            return self._wordcount
+        return self.feature('words') - self.parentfeature('words')
 
     @property
     def new(self):
@@ -259,11 +403,15 @@ class Revision(object):
 
     @property
     def redirect(self):
-        return bool(re.match(r'#(OMDIRIGERING|REDIRECT)', self.text))
+        return self.feature('redirect')
 
     @property
     def parentredirect(self):
-        return bool(re.match(r'#(OMDIRIGERING|REDIRECT)', self.parenttext))
+        return self.parentfeature('redirect')
+
+    def get_inputs(self):
+        """ The revision data that the rules look at, see User.analyze """
+        return json.dumps([self.timestamp, self.parentid, self.size, self.parentsize, self.texthash, self.parenthash])
 
     def get_link(self):
         """ returns a link to revision """
@@ -277,6 +425,17 @@ class Revision(object):
         q = {'title': self.article.name.encode('utf-8'), 'oldid': self.parentid}
         return '//' + self.article.site.host + self.article.site.site['script'] + '?' + urllib.urlencode(q)
 
+    def add_points(self, points, ptype, txt, raw=None):
+        """
+        Gives points to the revision. `raw` is the number of points before any max was applied.
+        """
+        if raw is None:
+            self.points.append((points, ptype, txt))
+            raw = points
+        else:
+            self.points.append((points, ptype, txt, raw))
+        self.article.count_points(self, ptype, points, raw)
+
     def get_points(self, ptype='', ignore_max=False):
         p = 0.0
         for pnt in self.points:
@@ -295,16 +454,42 @@ class User(object):
         self.articles = odict()
         self.contest = contest
         self.suspended_since = None
+        self.suspended_ts = None   # suspended_since as a Unix time, set by analyze
+        self.timeline = Timeline([], [])   # set by analyze
+        self._points = None
         self.disqualified_articles = []
         self.point_deductions = []
 
+        # Contributions from different sites may be fetched in parallel threads,
+        # so modifications to self.articles must hold this lock
+        self.lock = threading.RLock()
+
+        # Site keys mapped to the time of the last full resync, see UK.add_contribs_from_wiki
+        self.fullsync = {}
+
+        # Index of all the user's revisions by revision id, and by (site key, parent id).
+        # Kept up to date by index_revision as revisions are added.
+        self.revisions = {}
+        self.parents = {}
+
     def __repr__(self):
         return ("<User %s>" % self.name).encode('utf-8')
 
-    @property
-    def revisions(self):
-        # oh my, funny (and fast) one-liner for making a flat list of revisions
-        return {rev.revid: rev for article in self.articles.values() for rev in article.revisions.values()}
+    def index_revision(self, rev):
+        """ Adds a revision to the indices. Must be called again if rev.parentid changes. """
+        self.revisions[rev.revid] = rev
+        if not rev.new:
+            revs = self.parents.setdefault((rev.article.site.key, rev.parentid), [])
+            if not rev in revs:
+                revs.append(rev)
+
+    def reindex_revisions(self):
+        """ Rebuilds the indices from self.articles """
+        self.revisions = {}
+        self.parents = {}
+        for article in self.articles.itervalues():
+            for rev in article.revisions.itervalues():
+                self.index_revision(rev)
 
     def sort_contribs(self):
 
@@ -315,8 +500,8 @@ class User(object):
         # sort articles by first revision id
         self.articles.sort(key=lambda x: x[1].revisions.firstkey())
 
-    def add_article_if_necessary(self, site_key, article_title):
-        article_key = site_key + ':' + article_title
+    def add_article_if_necessary(self, site, article_title):
+        article_key = site.key + ':' + article_title
 
         if not article_key in self.articles:
             self.articles[article_key] = Article(site, self, article_title)
@@ -325,35 +510,18 @@ class User(object):
 
         return self.articles[article_key]
 
-    def add_contribs_from_wiki(self, site, start, end, fulltext=False, **kwargs):
+    def add_contribs(self, site, contribs):
         """
-        Populates self.articles with entries from the API.
+        Adds revisions from a list of usercontributions entries to self.articles.
+        Returns the list of new revisions.
 
             site      : mwclient.client.Site object
-            start     : datetime object with timezone Europe/Oslo
-            end       : datetime object with timezone Europe/Oslo
-            fulltext  : get revision fulltexts
+            contribs  : list of usercontributions entries
         """
-        apilim = 50
-        if 'bot' in site.rights:
-            apilim = site.api_limit         # API limit, should be 500
-
-        site_key = site.host.split('.')[0]
-
-        ts_start = start.astimezone(pytz.utc).strftime('%FT%TZ')
-        ts_end = end.astimezone(pytz.utc).strftime('%FT%TZ')
-
-        # 1) Fetch user contributions
-
-        args = {}
-        if 'namespace' in kwargs:
-            args['namespace'] = kwargs['namespace']
-            log(' -> Limiting to namespace: %d' % args['namespace'])
-
-        #new_articles = []
+        site_key = site.key
         new_revisions = []
         n_articles = len(self.articles)
-        for c in site.usercontributions(self.name, ts_start, ts_end, 'newer', prop='ids|title|timestamp|comment', **args):
+        for c in contribs:
             #pageid = c['pageid']
             if 'comment' in c:
                 article_comment = c['comment']
@@ -370,20 +538,20 @@ class User(object):
                         if self.revisions[rev_id].article.name != article_title:
                             rev = self.revisions[rev_id]
                             log(' -> Moving revision %d from "%s" to "%s"' % (rev_id, rev.article.name, article_title))
-                            article = self.add_article_if_necessary(site_key, article_title)
+                            article = self.add_article_if_necessary(site, article_title)
                             rev.article.revisions.pop(rev_id)  # remove from old article
                             article.revisions[rev_id] = rev    # add to new article
                             rev.article = article              # and update reference
 
                     else:
 
-                        article = self.add_article_if_necessary(site_key, article_title)
-                        rev = article.add_revision(rev_id, timestamp=time.mktime(c['timestamp']))
+                        article = self.add_article_if_necessary(site, article_title)
+                        rev = article.add_revision(rev_id, timestamp=calendar.timegm(c['timestamp']))
                         new_revisions.append(rev)
 
         # If revisions were moved from one article to another, and the redirect was not created by the same user,
         # some articles may now have zero revisions. We should drop them
-        for article_key, article in self.articles.iteritems():
+        for article_key, article in self.articles.items():
             if len(article.revisions) == 0:
                 log('--> Dropping article "%s" due to zero remaining revisions' % (article.name))
                 del self.articles[article_key]
@@ -392,7 +560,43 @@ class User(object):
         new_articles = len(self.articles) - n_articles
         self.sort_contribs()
         if len(new_revisions) > 0 or new_articles > 0:
-            log(" -> [%s] Added %d new revisions, %d new articles from API" % (site_key, len(new_revisions), new_articles))
+            log(" -> [%s] Added %d new revisions, %d new articles from API for %s" % (site_key, len(new_revisions), new_articles, self.name))
+
+        return new_revisions
+
+    def add_contribs_from_wiki(self, site, start, end, needs=(), contribs=None, **kwargs):
+        """
+        Populates self.articles with entries from the API.
+
+            site      : mwclient.client.Site object
+            start     : datetime object with timezone Europe/Oslo
+            end       : datetime object with timezone Europe/Oslo
+            needs     : revision data needed by the rules and filters, see Rule.needs.
+                        Revision texts are only fetched if asked for here.
+            contribs  : usercontributions entries already fetched by UK.sweep_contribs,
+                        or None to fetch them here
+        """
+        apilim = 50
+        if 'bot' in site.rights:
+            apilim = site.api_limit         # API limit, should be 500
+
+        site_key = site.host.split('.')[0]
+
+        ts_start = start.astimezone(pytz.utc).strftime('%FT%TZ')
+        ts_end = end.astimezone(pytz.utc).strftime('%FT%TZ')
+
+        # 1) Fetch user contributions
+
+        if contribs is None:
+            args = {}
+            if 'namespace' in kwargs:
+                args['namespace'] = kwargs['namespace']
+                log(' -> Limiting to namespace: %d' % args['namespace'])
+
+            contribs = list(site.usercontributions(self.name, ts_start, ts_end, 'newer', prop='ids|title|timestamp|comment', **args))
+
+        with self.lock:
+            new_revisions = self.add_contribs(site, contribs)
 
         # 2) Check if pages are redirects (this information can not be cached, because other users may make the page a redirect)
         #    If we fail to notice a redirect, the contributions to the page will be double-counted, so lets check
@@ -407,7 +611,7 @@ class User(object):
         # 3) Fetch info about the new revisions: diff size, possibly content
 
         props = 'ids|size'
-        if fulltext:
+        if 'text' in needs:
             props += '|content'
         revids = [str(r.revid) for r in new_revisions]
         parentids = []
@@ -416,84 +620,193 @@ class User(object):
             #print "API limit is ",apilim," getting ",s0
             ids = '|'.join(revids[s0:s0+apilim])
             for page in site.api('query', prop='revisions', rvprop=props, revids=ids)['query']['pages'].itervalues():
-                article_key = site_key + ':' + page['title']
                 for apirev in page['revisions']:
                     nr += 1
-                    rev = self.articles[article_key].revisions[apirev['revid']]
+                    rev = self.revisions[apirev['revid']]
                     rev.parentid = apirev['parentid']
                     rev.size = apirev['size']
                     if '*' in apirev.keys():
                         rev.text = apirev['*']
                     if not rev.new:
+                        self.index_revision(rev)
                         parentids.append(rev.parentid)
         if nr > 0:
-            log(" -> [%s] Checked %d of %d revisions, found %d parent revisions" % (site_key, nr, len(new_revisions), len(parentids)))
+            log(" -> [%s] Checked %d of %d revisions, found %d parent revisions for %s" % (site_key, nr, len(new_revisions), len(parentids), self.name))
 
         if nr != len(new_revisions):
             raise StandardError("Did not get all revisions")
 
+        # 3b) Fetch content we still need. This covers the new page revisions if only those are needed,
+        #     and revisions read from the DB without text, if the rules have changed since they were stored.
+
+        revs = [r for r in self.revisions.values() if r.article.site.key == site_key]
+        revids = [str(r.revid) for r in revs if not r.has_text and r.size > 0
+                  and ('text' in needs or ('newpagetext' in needs and r.new))]
+        nr = 0
+        for s0 in range(0, len(revids), apilim):
+            ids = '|'.join(revids[s0:s0+apilim])
+            for page in site.api('query', prop='revisions', rvprop='ids|content', revids=ids)['query']['pages'].itervalues():
+                for apirev in page['revisions']:
+                    nr += 1
+                    if '*' in apirev.keys():
+                        rev = self.revisions[apirev['revid']]
+                        rev.text = apirev['*']
+                        rev.dirty = True
+        if nr > 0:
+            log(" -> [%s] Fetched text of %d revisions for %s" % (site_key, nr, self.name))
+
         # 4) Fetch info about the parent revisions: diff size, possibly content
 
         props = 'ids|size'
-        if fulltext:
+        if 'parenttext' in needs:
             props += '|content'
+            parentids.extend([r.parentid for r in revs if not r.new and not r.has_parenttext and r.parentsize > 0])
+        parentids = set(parentids)
+
+        # 4a) The parent is often a revision we already have, like when an article is built
+        #     in many small saves, or a revision stored by another user. Then we don't need
+        #     to fetch it again.
+
+        found = self.find_parents(site_key, parentids, 'parenttext' in needs)
+        for parentid, (size, texthash) in found.iteritems():
+            for rev in self.parents[(site_key, parentid)]:
+                rev.parentsize = size
+                if texthash is not None:
+                    rev.parenthash = texthash
+                rev.dirty = True
+        parentids.difference_update(found.keys())
+        if len(found) > 0:
+            log(" -> [%s] Found %d parent revisions locally for %s" % (site_key, len(found), self.name))
+
+        # 4b) Fetch the rest from the API
+
         nr = 0
-        parentids = [str(i) for i in parentids]
+        parentids = [str(i) for i in sorted(parentids)]
         for s0 in range(0, len(parentids), apilim):
             ids = '|'.join(parentids[s0:s0+apilim])
             for page in site.api('query', prop='revisions', rvprop=props, revids=ids)['query']['pages'].itervalues():
-                article_key = site_key + ':' + page['title']
-                article = self.articles[article_key]
                 for apirev in page['revisions']:
                     nr += 1
                     parentid = apirev['revid']
-                    found = False
-                    for revid, rev in article.revisions.iteritems():
-                        if rev.parentid == parentid:
-                            found = True
-                            break
-                    if not found:
+                    if not (site_key, parentid) in self.parents:
                         raise StandardError("No revision found matching title=%s, parentid=%d" % (page['title'], parentid))
 
-                    rev.parentsize = apirev['size']
-                    if '*' in apirev.keys():
-                        rev.parenttext = apirev['*']
+                    for rev in self.parents[(site_key, parentid)]:
+                        rev.parentsize = apirev['size']
+                        if '*' in apirev.keys():
+                            rev.parenttext = apirev['*']
+                        rev.dirty = True
         if nr > 0:
-            log(" -> [%s] Checked %d parent revisions" % (site_key, nr))
+            log(" -> [%s] Checked %d parent revisions for %s" % (site_key, nr, self.name))
+
+    def find_parents(self, site_key, parentids, fulltext):
+        """
+        Looks up parent revisions among the revisions in memory, or in the DB.
+        Returns a dict mapping parent ids to (size, texthash), where texthash is None
+        unless fulltext is True.
+        """
+        found = {}
+        for parentid in parentids:
+            rev = self.revisions.get(parentid)
+            if rev is not None and rev.article.site.key == site_key and rev.size >= 0:
+                if not fulltext:
+                    found[parentid] = (rev.size, None)
+                elif rev.has_text or rev.size == 0:
+                    found[parentid] = (rev.size, rev.texthash)
+
+        remaining = [i for i in parentids if i not in found]
+        if len(remaining) == 0:
+            return found
+
+        # May be called from a worker thread, see UK.add_contribs_from_wiki
+        cur = self.contest.get_sql().cursor()
+        for s0 in range(0, len(remaining), 500):
+            ids = remaining[s0:s0+500]
+            if fulltext:
+                # The size of a revision is the length of its text in bytes
+                q = u"""SELECT f.revid, f.hash, t.size FROM fulltexts AS f JOIN texts AS t ON t.hash = f.hash
+                        WHERE f.site=? AND f.revid IN (%s)""" % ','.join(['?'] * len(ids))
+                rows = cur.execute(q, [site_key] + ids).fetchall()
+                self.contest.texts.load(cur, [row[1] for row in rows])
+                for revid, texthash, size in rows:
+                    found[revid] = (size, texthash)
+            else:
+                q = u'SELECT revid, size FROM contribs WHERE site=? AND revid IN (%s)' % ','.join(['?'] * len(ids))
+                for revid, size in cur.execute(q, [site_key] + ids):
+                    found[revid] = (size, None)
+        cur.close()
+        return found
 
     def save_contribs_to_db(self, sql):
-        """ Save self.articles to DB so it can be read by add_contribs_from_db """
+        """
+        Save self.articles to DB so it can be read by add_contribs_from_db.
+        Only revisions marked as dirty are written, in a single transaction.
+        """
 
-        cur = sql.cursor()
-        nrevs = 0
-        ntexts = 0
+        revs = []
+        contribs = []
+        fulltexts = {}
+        bases = {}   # text hash -> parent text hash, for storing texts as deltas
 
         for article_key, article in self.articles.iteritems():
             site_key = article.site.key
 
             for revid, rev in article.revisions.iteritems():
-                ts = datetime.fromtimestamp(rev.timestamp).strftime('%F %T')
+                if not rev.dirty:
+                    continue
+                revs.append(rev)
+                contribs.append((revid, site_key, rev.parentid, self.name, article.name, rev.timestamp, rev.size, rev.parentsize))
+
+                # Save revision text and parent revision text if we have them
+                if rev.has_text:
+                    fulltexts[(revid, site_key)] = rev.texthash
+                    bases[rev.texthash] = rev.parenthash
+                if rev.has_parenttext:
+                    fulltexts[(rev.parentid, site_key)] = rev.parenthash
+                    bases.setdefault(rev.parenthash, None)
+
+        if len(revs) == 0:
+            return
+
+        # Rows that are already saved are left as they are
+        cur = sql.cursor()
+        cur.executemany(u'INSERT OR IGNORE INTO contribs (revid, site, parentid, user, page, timestamp, size, parentsize) VALUES (?,?,?,?,?,?,?,?)',
+                        contribs)
+        nrevs = cur.rowcount
+        ntexts = self.contest.texts.save(cur, bases)
+        cur.executemany(u'INSERT OR IGNORE INTO fulltexts (revid, site, hash) VALUES (?,?,?)',
+                        [(revid, site_key, texthash) for (revid, site_key), texthash in fulltexts.iteritems()])
+        sql.commit()
+        cur.close()
 
-                # Save revision if not already saved
-                if len(cur.execute(u'SELECT revid FROM contribs WHERE revid=? AND site=?', [revid, site_key]).fetchall()) == 0:
-                    cur.execute(u'INSERT INTO contribs (revid, site, parentid, user, page, timestamp, size, parentsize) VALUES (?,?,?,?,?,?,?,?)',
-                                (revid, site_key, rev.parentid, self.name, article.name, ts, rev.size, rev.parentsize))
-                    nrevs += 1
+        for rev in revs:
+            rev.dirty = False
 
-                # Save revision text if we have it and if not already saved
-                if len(rev.text) > 0 and len(cur.execute(u'SELECT revid FROM fulltexts WHERE revid=? AND site=?', [revid, site_key]).fetchall()) == 0:
-                    cur.execute(u'INSERT INTO fulltexts (revid, site, revtxt) VALUES (?,?,?)', (revid, site_key, rev.text))
-                    ntexts += 1
+        if nrevs > 0 or ntexts > 0:
+            log(" -> Wrote %d revisions and %d texts to DB" % (nrevs, ntexts))
 
-                # Save parent revision text if we have it and if not already saved
-                if len(rev.parenttext) > 0 and len(cur.execute(u'SELECT revid FROM fulltexts WHERE revid=? AND site=?', [rev.parentid, site_key]).fetchall()) == 0:
-                    cur.execute(u'INSERT INTO fulltexts (revid, site, revtxt) VALUES (?,?,?)', (rev.parentid, site_key, rev.parenttext))
-                    ntexts += 1
+    def save_watermarks(self, sql):
+        """
+        Save the last revision seen on each site, so that the next run only needs to
+        ask the API for contributions made after it. Sites where the user has no
+        contributions get revid 0 and the time the contributions were fetched.
+        """
+        last = {}
+        for rev in self.revisions.itervalues():
+            site_key = rev.article.site.key
+            if not site_key in last or (rev.timestamp, rev.revid) > (last[site_key].timestamp, last[site_key].revid):
+                last[site_key] = rev
 
+        cur = sql.cursor()
+        for site_key in set(self.fullsync.keys() + last.keys()):
+            if site_key in last:
+                revid, ts = last[site_key].revid, last[site_key].timestamp
+            else:
+                revid, ts = 0, self.contest.sync_ts
+            cur.execute(u'INSERT OR REPLACE INTO watermarks (contest, user, site, revid, timestamp, fullsync) VALUES (?,?,?,?,?,?)',
+                        (self.contest.name, self.name, site_key, revid, ts, self.fullsync.get(site_key, 0)))
         sql.commit()
         cur.close()
-        if nrevs > 0 or ntexts > 0:
-            log(" -> Wrote %d revisions and %d fulltexts to DB" % (nrevs, ntexts))
 
     def add_contribs_from_db(self, sql, start, end, sites):
         """
@@ -504,19 +817,25 @@ class User(object):
             end   : datetime object
         """
         cur = sql.cursor()
-        cur2 = sql.cursor()
-        ts_start = start.astimezone(pytz.utc).strftime('%F %T')
-        ts_end = end.astimezone(pytz.utc).strftime('%F %T')
+        ts_start = int(unix_time(start))
+        ts_end = int(unix_time(end))
         nrevs = 0
         narts = 0
-        for row in cur.execute(u"""SELECT revid, site, parentid, page, timestamp, size, parentsize FROM contribs
-                                   WHERE user=? AND timestamp >= ? AND timestamp <= ?""", (self.name, ts_start, ts_end)):
 
-            rev_id, site_key, parent_id, article_title, ts, size, parentsize = row
+        # The hashes of the revision text and the parent revision text are joined in.
+        # The texts themselves are read afterwards, once for each distinct text,
+        # and decompressed when first used.
+        texthashes = []
+        for row in cur.execute(u"""SELECT c.revid, c.site, c.parentid, c.page, c.timestamp,
+                                          c.size, c.parentsize, t.hash, pt.hash
+                                   FROM contribs AS c
+                                   LEFT JOIN fulltexts AS t ON t.revid = c.revid AND t.site = c.site
+                                   LEFT JOIN fulltexts AS pt ON pt.revid = c.parentid AND pt.site = c.site AND c.parentid != 0
+                                   WHERE c.user=? AND c.timestamp >= ? AND c.timestamp <= ?""", (self.name, ts_start, ts_end)):
+
+            rev_id, site_key, parent_id, article_title, ts, size, parentsize, texthash, parenthash = row
             article_key = site_key + ':' + article_title
 
-            ts = unix_time(pytz.utc.localize(datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')))
-
             # Add article if not present
             if not article_key in self.articles:
                 narts += 1
@@ -531,17 +850,19 @@ class User(object):
                 article.add_revision(rev_id, timestamp=ts, parentid=parent_id, size=size, parentsize=parentsize)
             rev = self.revisions[rev_id]
 
-            # Add revision text
-            for row2 in cur2.execute(u"""SELECT revtxt FROM fulltexts WHERE revid=? AND site=?""", [rev_id, site_key]):
-                rev.text = row2[0]
+            # Add revision text and parent revision text
+            if texthash is not None:
+                rev.texthash = texthash
+                texthashes.append(texthash)
+            if parenthash is not None:
+                rev.parenthash = parenthash
+                texthashes.append(parenthash)
 
-            # Add parent revision text
-            if not rev.new:
-                for row2 in cur2.execute(u"""SELECT revtxt FROM fulltexts WHERE revid=? AND site=?""", [parent_id, site_key]):
-                    rev.parenttext = row2[0]
+            # Already stored, so save_contribs_to_db can skip it
+            rev.dirty = False
 
+        self.contest.texts.load(cur, texthashes)
         cur.close()
-        cur2.close()
 
         # Always sort after we've added contribs
         self.sort_contribs()
@@ -575,6 +896,7 @@ class User(object):
 
         # We should re-sort afterwards since not all filters preserve the order (notably the CatFilter)
         self.sort_contribs()
+        self.reindex_revisions()
 
         log(" -> %d articles remain after filtering" % len(self.articles))
         if self.contest.verbose:
@@ -598,55 +920,115 @@ class User(object):
     @property
     def points(self):
         """ The points for all the user's articles, excluding disqualified ones """
-        p = 0.
-        for article_key, article in self.articles.iteritems():
-            p += article.get_points()
-        return p
+        if self._points is None:
+            p = 0.
+            for article_key, article in self.articles.iteritems():
+                p += article.get_points()
+            self._points = p
+        return self._points
         #return np.sum([a.points for a in self.articles.values()])
 
-    def analyze(self, rules):
+    def load_points(self, cur):
+        """ Reads the points stored for the user's revisions, see analyze """
+        stored = {}
+        revids = {}
+        for article in self.articles.itervalues():
+            revids.setdefault(article.site.key, []).extend(article.revisions.keys())
+        for site_key, ids in revids.iteritems():
+            for s0 in range(0, len(ids), 500):
+                q = 'SELECT revid, fingerprint, prevrevid, inputs, points FROM points WHERE contest=? AND site=? AND revid IN (%s)' % ','.join(['?'] * len(ids[s0:s0+500]))
+                for row in cur.execute(q, [self.contest.name, site_key] + ids[s0:s0+500]):
+                    stored[(site_key, row[0])] = row[1:]
+        return stored
+
+    def analyze(self, rules, pool=None):
+        """
+        Gives points to the revisions. If a multiprocessing.Pool is given, the features
+        the rules need are computed in its processes first.
+
+        The points given to each revision are stored, together with a fingerprint of the
+        rules and of the state of the article. As long as the fingerprint, the revision
+        and the revisions before it in the article are unchanged, the stored points are
+        given again instead of testing the rules. From the first new or changed revision
+        on, the rules are tested, since a rule may depend on the points given earlier.
+        Rules keeping statistics are told about the skipped revisions with Rule.tally.
+        """
 
-        x = []
-        y = []
+        timestamps = []
+        points = []
         utc = pytz.utc
 
+        # Features already computed in earlier runs are read from the DB, so only the texts
+        # of new revisions need to be analyzed
+        sql = self.contest.get_sql()
+        cur = sql.cursor()
+        texthashes = []
+        for rev in self.revisions.itervalues():
+            texthashes.extend([rev.texthash, rev.parenthash])
+        self.contest.features.load(cur, texthashes)
+        if pool is not None:
+            self.contest.features.compute(texthashes, self.contest.pool_features, pool)
+
+        # Revisions are compared with the suspension time as Unix times
+        if self.suspended_since is None:
+            self.suspended_ts = None
+        else:
+            self.suspended_ts = unix_time(self.suspended_since)
+        self._points = None
+
+        stored = self.load_points(cur)
+        new_points = []
+
         # loop over articles
         for article_key, article in self.articles.iteritems():
             log('.', newline=False)
             #log(article_key)
 
+            article.reset_points()
+            fingerprint = article.get_fingerprint()
+            prevrevid = None
+            reuse = True
+
             # loop over revisions
             for revid, rev in article.revisions.iteritems():
 
-                rev.points = []
+                inputs = rev.get_inputs()
+                record = stored.get((article.site.key, revid))
+                if reuse and record is not None and tuple(record[:3]) == (fingerprint, prevrevid, inputs):
+                    for pnt in json.loads(record[3]):
+                        rev.add_points(*pnt)
+                    for rule in rules:
+                        rule.tally(rev)
+                else:
+                    reuse = False
+
+                    # loop over rules
+                    for rule in rules:
+                        #log('   %d : %s' % (revid, type(rule).__name__))
+                        rule.test(rev)
 
-                # loop over rules
-                for rule in rules:
-                    #log('   %d : %s' % (revid, type(rule).__name__))
-                    rule.test(rev)
+                    new_points.append((self.contest.name, article.site.key, revid, fingerprint, prevrevid, inputs, json.dumps(rev.points)))
+                prevrevid = revid
 
                 if not article.disqualified:
 
-                    dt = pytz.utc.localize(datetime.fromtimestamp(rev.timestamp))
-                    if self.suspended_since is None or dt < self.suspended_since:
+                    if self.suspended_ts is None or rev.timestamp < self.suspended_ts:
 
-                        if rev.get_points() > 0:
-                            #print self.name, rev.timestamp, rev.get_points()
-                            ts = float(unix_time(utc.localize(datetime.fromtimestamp(rev.timestamp)).astimezone(wiki_tz)))
-                            x.append(ts)
-                            y.append(float(rev.get_points()))
+                        p = rev.get_points()
+                        if p > 0:
+                            #print self.name, rev.timestamp, p
+                            timestamps.append(rev.timestamp)
+                            points.append(p)
 
-        x = np.array(x)
-        y = np.array(y)
+        self.timeline = Timeline(timestamps, points)
+        #np.savetxt('user-%s'%self.name, np.column_stack((self.timeline.time, self.timeline.points, self.timeline.total)))
+        self._points = None
 
-        o = np.argsort(x)
-        x = x[o]
-        y = y[o]
-        #pl = np.array(pl, dtype=float)
-        #pl.sort(axis = 0)
-        y2 = np.array([np.sum(y[:q+1]) for q in range(len(y))])
-        self.plotdata = np.column_stack((x, y2))
-        #np.savetxt('user-%s'%self.name, np.column_stack((x,y,y2)))
+        self.contest.features.save(cur)
+        cur.executemany('INSERT OR REPLACE INTO points (contest, site, revid, fingerprint, prevrevid, inputs, points) VALUES (?,?,?,?,?,?,?)',
+                        new_points)
+        sql.commit()
+        cur.close()
 
     def format_result(self, pos=-1, closing=False, prices=[]):
 
@@ -676,7 +1058,7 @@ class User(object):
 
                     if len(rev.points) > 0:
                         descr = ' + '.join(['%.1f p (%s)' % (p[0], p[2]) for p in rev.points])
-                        dt = utc.localize(datetime.fromtimestamp(rev.timestamp))
+                        dt = utc.localize(datetime.utcfromtimestamp(rev.timestamp))
                         dt_str = dt.astimezone(wiki_tz).strftime('%A, %H:%M').decode('utf-8')
                         out = '[%s %s]: %s' % (rev.get_link(), dt_str, descr)
                         if self.suspended_since is not None and dt > self.suspended_since:
@@ -697,7 +1079,12 @@ class User(object):
                         pds.append('%.f p: %s' % (-points, reason))
                     titletxt += '<div style="border-top:1px solid #CCC">\'\'' + _('Notes') + ':\'\'<br />%s</div>' % '<br />'.join(pds)
 
-                titletxt += '<div style="border-top:1px solid #CCC">' + _('Total: {{formatnum:%(bytecount)d}} bytes, %(wordcount)d words') % {'bytecount': article.bytes, 'wordcount': article.words} + '.</div>'
+                if 'text' in self.contest.needs:
+                    total = _('Total: {{formatnum:%(bytecount)d}} bytes, %(wordcount)d words') % {'bytecount': article.bytes, 'wordcount': article.words}
+                else:
+                    # We don't have the texts to count words
+                    total = _('Total: {{formatnum:%(bytecount)d}} bytes') % {'bytecount': article.bytes}
+                titletxt += '<div style="border-top:1px solid #CCC">' + total + '.</div>'
 
                 p = '%.1f p' % brutto
                 if brutto != netto:
@@ -749,6 +1136,19 @@ class User(object):
         return out
 
 
+def get_rules_fingerprint(rules, locale):
+    """
+    Identifies the rules of a contest and the code and settings they give points with,
+    see User.analyze
+    """
+    return hashlib.sha1(json.dumps([
+        SCORING_VERSION,
+        locale,
+        [r.get_fingerprint() for r in rules],
+        sorted([[name, v[0]] for name, v in ukfeatures.EXTRACTORS.iteritems()]),
+    ])).hexdigest()
+
+
 class UK(object):
 
     def __init__(self, page, catignore, sites, homesite, sql, config, verbose=False):
@@ -773,6 +1173,10 @@ class UK(object):
 
         self.verbose = verbose
         self.sql = sql
+        self.local = threading.local()
+        self.texts = ukdb.TextStore(config.get('textdeltas', 0))
+        self.features = ukfeatures.FeatureCache(self.texts)
+        self.sync_ts = None   # set by add_contribs_from_wiki
         sections = [s.strip() for s in re.findall('^[\s]*==([^=]+)==', txt, flags=re.M)]
         self.results_section = sections.index(resultsSection) + 1
 
@@ -780,11 +1184,151 @@ class UK(object):
         self.users = [User(n, self) for n in self.extract_userlist(txt)]
         self.rules, self.filters = self.extract_rules(txt, catignore)
 
+        # Stored points are only reused with the same rules, see User.analyze
+        self.rules_fingerprint = get_rules_fingerprint(self.rules, config['locale'])
+
+        # The text of new page revisions is always needed, to tell new pages from redirects
+        self.needs = set(['newpagetext'])
+        for r in self.rules + self.filters:
+            self.needs.update(r.needs)
+
+        # Features that User.analyze computes in a process pool, if there is one
+        self.pool_features = set()
+        for r in self.rules:
+            self.pool_features.update([name for name in r.features if not name in ukfeatures.REGIONS])
+
         if self.startweek == self.endweek:
             log('@ Week %d' % self.startweek)
         else:
             log('@ Week %d–%d' % (self.startweek, self.endweek))
 
+    def get_sql(self):
+        """
+        Returns a connection to the DB that can be used from the calling thread,
+        since a sqlite3 connection can only be used in the thread that created it.
+        """
+        if isinstance(threading.current_thread(), threading._MainThread):
+            return self.sql
+        if not hasattr(self.local, 'sql'):
+            self.local.sql = ukdb.connect(self.config['db'])
+        return self.local.sql
+
+    def get_watermarks(self):
+        """
+        Returns a dict mapping (user name, site key) to (timestamp, fullsync) for the last
+        revision seen in a previous run and the time of the last full resync.
+        """
+        cur = self.sql.cursor()
+        watermarks = {}
+        for row in cur.execute(u'SELECT user, site, timestamp, fullsync FROM watermarks WHERE contest=?', [self.name]):
+            watermarks[(row[0], row[1])] = (row[2], row[3])
+        cur.close()
+        return watermarks
+
+    def sweep_contribs(self, site, users, start, namespace=None):
+        """
+        Fetches the contributions of the given participants on a site in one go, by asking
+        for many users per usercontributions query (ucuser=A|B|C), rather than making
+        one query per participant. The number of requests then scales with the number
+        of edits rather than the number of participants.
+
+        Returns a dict mapping user names to lists of usercontributions entries.
+        """
+        apilim = 50
+        if 'bot' in site.rights:
+            apilim = site.api_limit         # API limit, should be 500
+
+        ts_start = start.astimezone(pytz.utc).strftime('%FT%TZ')
+        ts_end = self.end.astimezone(pytz.utc).strftime('%FT%TZ')
+
+        # The API returns normalized user names, so we need to normalize ours too
+        normalized = {}
+        for u in users:
+            name = u.name.replace('_', ' ').strip()
+            normalized[name[:1].upper() + name[1:]] = u.name
+
+        contribs = {u.name: [] for u in users}
+        names = sorted(normalized.keys())
+        nc = 0
+        for s0 in range(0, len(names), apilim):
+            for c in site.usercontributions('|'.join(names[s0:s0+apilim]), ts_start, ts_end, 'newer',
+                                            prop='ids|title|timestamp|comment', namespace=namespace):
+                if c['user'] in normalized:
+                    contribs[normalized[c['user']]].append(c)
+                    nc += 1
+
+        log(' -> [%s] Found %d contributions by %d users' % (site.key, nc, len(names)))
+        return contribs
+
+    def add_contribs_from_wiki(self, workers=1, sweep=False, resync=24, full=False, **kwargs):
+        """
+        Fills in new contributions from the wiki for all users and sites.
+
+            workers : max number of (user, site) pairs to fetch at the same time
+            sweep   : fetch the contributions of all users at once, see sweep_contribs
+            resync  : hours between each time the full contest period is fetched again
+            full    : fetch the full contest period now
+
+        Unless a full resync is due, we only ask for contributions made after the last
+        revision seen in the previous run (the high-water mark saved by User.save_watermarks).
+        Contributions older than that are read from the DB. The periodic full resync catches
+        up with page moves and rollbacks affecting older contributions.
+
+        Only the network-bound fetching is done in parallel. Reading and writing
+        the DB, filtering and analysis is left to the main thread.
+        """
+        now = int(clock.time())
+        # Saved by User.save_watermarks for sites without contributions
+        self.sync_ts = now
+        watermarks = self.get_watermarks()
+        since = {}
+        for u in self.users:
+            for site_key in self.sites:
+                ts, fullsync = watermarks.get((u.name, site_key), (0, 0))
+                if full or now - fullsync >= resync * 3600:
+                    u.fullsync[site_key] = now
+                else:
+                    u.fullsync[site_key] = fullsync
+                    since[(u.name, site_key)] = max(self.start, pytz.utc.localize(datetime.utcfromtimestamp(ts)))
+        nfull = len(self.users) * len(self.sites) - len(since)
+        if nfull > 0:
+            log(' -> Doing full resync for %d of %d users/sites' % (nfull, len(self.users) * len(self.sites)))
+
+        contribs = {}
+        if sweep:
+            for site in self.sites.itervalues():
+                # One query for the users due for a full resync, from the start of the contest,
+                # and one for the rest, from the earliest of their watermarks
+                contribs[site.key] = {}
+                full_users = [u for u in self.users if not (u.name, site.key) in since]
+                users = [u for u in self.users if (u.name, site.key) in since]
+                if len(full_users) > 0:
+                    contribs[site.key].update(self.sweep_contribs(site, full_users, self.start, kwargs.get('namespace')))
+                if len(users) > 0:
+                    start = min([since[(u.name, site.key)] for u in users])
+                    contribs[site.key].update(self.sweep_contribs(site, users, start, kwargs.get('namespace')))
+
+        tasks = [(u, site) for u in self.users for site in self.sites.itervalues()]
+
+        def fetch(task):
+            user, site = task
+            args = dict(kwargs)
+            if sweep:
+                args['contribs'] = contribs[site.key][user.name]
+            start = since.get((user.name, site.key), self.start)
+            user.add_contribs_from_wiki(site, start, self.end, **args)
+
+        if workers > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                pool.map(fetch, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                fetch(task)
+
     def extract_userlist(self, txt):
         lst = []
         m = re.search('==\s*' + self.config['contestPages']['participantsSection'] + '\s*==', txt)
@@ -1135,15 +1679,15 @@ class UK(object):
         xt = t0 + np.arange(ndays + 1) * 86400
         xt_mid = t0 + 43200 + np.arange(ndays) * 86400
 
-        now = float(unix_time(server_tz.localize(datetime.now()).astimezone(pytz.utc)))
+        now = float(unix_time(server_tz.localize(clock.now()).astimezone(pytz.utc)))
 
         yall = []
         cnt = 0
         for u in self.users:
-            if u.plotdata.shape[0] > 0:
+            if len(u.timeline) > 0:
                 cnt += 1
-                x = list(u.plotdata[:, 0])
-                y = list(u.plotdata[:, 1])
+                x = list(u.timeline.time)
+                y = list(u.timeline.total)
                 yall.extend(y)
                 x.insert(0, xt[0])
                 y.insert(0, 0)
@@ -1258,7 +1802,7 @@ class UK(object):
                         break
                 mld += '}}\n'
 
-            now = server_tz.localize(datetime.now())
+            now = server_tz.localize(clock.now())
             yearweek = now.astimezone(wiki_tz).strftime('%Y-%V')
             userprefix = self.homesite.namespaces[2]
             usertalkprefix = self.homesite.namespaces[3]
@@ -1345,28 +1889,58 @@ class UK(object):
 
     def delete_contribs_from_db(self):
         cur = self.sql.cursor()
-        cur2 = self.sql.cursor()
-        ts_start = self.start.astimezone(pytz.utc).strftime('%F %T')
-        ts_end = self.end.astimezone(pytz.utc).strftime('%F %T')
-        ndel = 0
-        for row in cur.execute(u"SELECT site,revid,parentid FROM contribs WHERE timestamp >= ? AND timestamp <= ?", (ts_start, ts_end)):
-            row2 = cur2.execute(u"DELETE FROM fulltexts WHERE site=? AND revid=?", [row[0], row[1]])
-            ndel += row2.rowcount
-            row2 = cur2.execute(u"DELETE FROM fulltexts WHERE site=? AND revid=?", [row[0], row[2]])
-            ndel += row2.rowcount
-
+        ts_start = int(unix_time(self.start))
+        ts_end = int(unix_time(self.end))
+
+        # Texts of the revisions and of their parent revisions
+        row = cur.execute(u"""DELETE FROM fulltexts WHERE (site, revid) IN (
+                                  SELECT site, revid FROM contribs WHERE timestamp >= ? AND timestamp <= ?
+                                  UNION SELECT site, parentid FROM contribs WHERE timestamp >= ? AND timestamp <= ?
+                              )""", (ts_start, ts_end, ts_start, ts_end))
+        ndel = row.rowcount
         nremain = cur.execute('SELECT COUNT(*) FROM fulltexts').fetchone()[0]
         log('> Cleaned %d rows from fulltexts-table. %d rows remain' % (ndel, nremain))
 
+        # Texts are shared between revisions, so only texts no longer used by any revision,
+        # or as the base of a delta, are deleted
+        row = cur.execute(u"""DELETE FROM texts WHERE hash NOT IN (
+                                  WITH RECURSIVE used(hash) AS (
+                                      SELECT hash FROM fulltexts
+                                      UNION SELECT texts.base FROM texts JOIN used ON texts.hash = used.hash WHERE texts.base IS NOT NULL
+                                  )
+                                  SELECT hash FROM used
+                              )""")
+        ndel = row.rowcount
+        nremain = cur.execute('SELECT COUNT(*) FROM texts').fetchone()[0]
+        log('> Cleaned %d rows from texts-table. %d rows remain' % (ndel, nremain))
+
+        row = cur.execute(u"DELETE FROM features WHERE hash NOT IN (SELECT hash FROM texts)")
+        ndel = row.rowcount
+        nremain = cur.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+        log('> Cleaned %d rows from features-table. %d rows remain' % (ndel, nremain))
+
+        row = cur.execute(u"""DELETE FROM points WHERE contest=? OR (site, revid) IN (
+                                  SELECT site, revid FROM contribs WHERE timestamp >= ? AND timestamp <= ?
+                              )""", (self.name, ts_start, ts_end))
+        ndel = row.rowcount
+        nremain = cur.execute('SELECT COUNT(*) FROM points').fetchone()[0]
+        log('> Cleaned %d rows from points-table. %d rows remain' % (ndel, nremain))
+
         row = cur.execute(u"""DELETE FROM contribs WHERE timestamp >= ? AND timestamp <= ?""", (ts_start, ts_end))
         ndel = row.rowcount
         nremain = cur.execute('SELECT COUNT(*) FROM contribs').fetchone()[0]
         log('> Cleaned %d rows from contribs-table. %d rows remain' % (ndel, nremain))
 
+        # The watermarks point at the contributions just deleted, so they must not be trusted anymore
+        row = cur.execute(u"DELETE FROM watermarks WHERE contest=?", [self.name])
+        log('> Cleaned %d rows from watermarks-table' % row.rowcount)
+
         cur.close()
-        cur2.close()
         self.sql.commit()
 
+        nbytes = ukdb.vacuum(self.sql, self.config.get('vacuum', 'incremental'))
+        log('> Reclaimed %.1f MB' % (nbytes / 1024. ** 2))
+
     def deliver_warnings(self, simulate=False):
         """
         Inform users about problems with their contribution(s)
@@ -1444,9 +2018,10 @@ if __name__ == '__main__':
             sites[prefix] = Site(host, config['account']['user'], config['account']['pass'])
 
     cpage = config['pages']['catignore']
-    sql = sqlite3.connect(config['db'])
+    sql = ukdb.connect(config['db'])
+    ukdb.migrate(sql)
 
-    now = server_tz.localize(datetime.now())
+    now = server_tz.localize(clock.now())
 
     # Determine kpage
 
@@ -1539,42 +2114,64 @@ if __name__ == '__main__':
         if type(f) == NamespaceFilter:
             extraargs['namespace'] = f.namespace
 
+    # First read contributions from db
     for u in uk.users:
         log("=== %s ===" % u.name)
-
-        # First read contributions from db
         u.add_contribs_from_db(sql, uk.start, uk.end, sites)
 
-        # Then fill in new contributions from wiki
-        for site in sites.itervalues():
-            u.add_contribs_from_wiki(site, uk.start, uk.end, fulltext=True, **extraargs)
+    # Then fill in new contributions from wiki
+    log("@ Fetching contributions from wiki")
+    uk.add_contribs_from_wiki(workers=config.get('workers', 1), sweep=config.get('sweep', False), resync=config.get('resync', 24),
+                              full=(ending or args.close), needs=uk.needs, **extraargs)
 
-        # And update db
-        u.save_contribs_to_db(sql)
+    # Processes for analyzing texts. Started here, after the threads fetching
+    # contributions have finished, since they are forked from this process.
+    pool = None
+    if config.get('processes', 1) > 1 and len(uk.pool_features) > 0:
+        pool = Pool(config['processes'])
 
-        try:
+    try:
+        for u in uk.users:
+            log("=== %s ===" % u.name)
 
-            # Filter out relevant articles
-            u.filter(uk.filters)
+            # And update db
+            u.save_contribs_to_db(sql)
+            u.save_watermarks(sql)
 
-            # And calculate points
-            log(' -> Analyzing ', newline=False)
-            u.analyze(uk.rules)
-            log('OK (%.f points)' % u.points)
+            try:
 
-            narticles += len(u.articles)
-            nbytes += u.bytes
-            nwords += u.words
-            nnewpages += u.newpages
+                # Filter out relevant articles
+                u.filter(uk.filters)
+
+                # And calculate points
+                log(' -> Analyzing ', newline=False)
+                u.analyze(uk.rules, pool)
+                log('OK (%.f points)' % u.points)
+
+                narticles += len(u.articles)
+                nbytes += u.bytes
+                if 'text' in uk.needs and 'parenttext' in uk.needs:
+                    # Words are only counted if the texts were fetched, see Rule.needs
+                    nwords += u.words
+                nnewpages += u.newpages
+
+            except ParseError as e:
+                err = "\n* '''%s'''" % e.msg
+                out = '\n{{%s | error | %s }}' % (config['templates']['botinfo'], err)
+                if args.simulate:
+                    print out
+                else:
+                    kpage.save('dummy', summary=_('UKBot encountered a problem'), appendtext=out)
+                raise
+    except:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
 
-        except ParseError as e:
-            err = "\n* '''%s'''" % e.msg
-            out = '\n{{%s | error | %s }}' % (config['templates']['botinfo'], err)
-            if args.simulate:
-                print out
-            else:
-                kpage.save('dummy', summary=_('UKBot encountered a problem'), appendtext=out)
-            raise
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # Sort users by points
 
@@ -1619,7 +2216,7 @@ if __name__ == '__main__':
 
     #out += sammen + '\n'
 
-    now = server_tz.localize(datetime.now())
+    now = server_tz.localize(clock.now())
     if ending:
         # Konkurransen er nå avsluttet – takk til alle som deltok! Rosetter vil bli delt ut så snart konkurransearrangøren(e) har sjekket resultatene.
         out += "''" + _('This contest is closed – thanks to everyone who participated! Awards will be sent out as soon as the contest organizer has checked the results.') + "''\n\n"
@@ -1791,6 +2388,6 @@ if __name__ == '__main__':
 
     uk.plot()
 
-    runend = server_tz.localize(datetime.now())
+    runend = server_tz.localize(clock.now())
     runtime = (runend - runstart).total_seconds()
     log('UKBot finishing at %s. Runtime was %.f seconds.' % (runend.strftime('%F %T'), runtime))
@@ -0,0 +1,384 @@
+#encoding=utf-8
+"""
+Opening the SQLite DB and keeping its schema up to date.
+
+The schema is storage/baseline.sql plus the migration scripts in storage/migrations,
+named like 002_description.sql. Applied migrations are recorded in the schemachanges
+table. Run this file with the path to the DB to apply migrations without running the bot:
+
+    python ukdb.py ../storage/uk.db
+
+Revision texts are stored once per distinct text in the texts table, keyed by the hash
+of the text, and the fulltexts table maps revisions to text hashes. Texts are stored
+compressed. The format column tells how the content is stored, so rows written before
+compression was introduced can still be read. To compress these rows in place, run
+
+    python ukdb.py --compress ../storage/uk.db
+"""
+from __future__ import unicode_literals
+import os
+import re
+import zlib
+import json
+import difflib
+import hashlib
+import sqlite3
+import argparse
+import subprocess
+from ukcommon import log
+
+STORAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'storage')
+
+# Values of texts.format
+TEXT_PLAIN = 0   # content is the text itself
+TEXT_ZLIB = 1    # content is the UTF-8 encoded text, compressed with zlib
+TEXT_DELTA = 2   # content is a delta against the text given by base, compressed with zlib
+
+
+def connect(filename, timeout=60):
+    """
+    Opens the DB in WAL mode, so that readers don't block the writer and the writer
+    doesn't block readers. This lets the update job and the --close job run at the
+    same time. When another process is writing, we wait up to `timeout` seconds
+    for it to finish, rather than failing with "database is locked".
+    """
+    sql = sqlite3.connect(filename, timeout=timeout)
+    sql.execute('PRAGMA journal_mode=WAL')
+    sql.execute('PRAGMA synchronous=NORMAL')
+    return sql
+
+
+def text_hash(txt):
+    """ The key of a text in the texts table: the SHA-1 of the UTF-8 encoded text """
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def encode_text(txt):
+    """ Returns (size, format, content) for storing a text in the texts table """
+    data = txt.encode('utf-8')
+    return len(data), TEXT_ZLIB, sqlite3.Binary(zlib.compress(data, 6))
+
+
+def decode_text(fmt, value):
+    """ Returns the text stored as (format, content) in the texts table. Deltas are decoded by TextStore. """
+    if fmt == TEXT_PLAIN:
+        return value
+    elif fmt == TEXT_ZLIB:
+        return zlib.decompress(value).decode('utf-8')
+    raise ValueError('Unknown text format: %r' % fmt)
+
+
+def make_delta(base, txt):
+    """
+    Returns a list of operations that turns base into txt, working on lines:
+    [i, j] copies lines i to j of base, and a string is inserted as it is.
+    """
+    a = base.splitlines(True)
+    b = txt.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(base, ops):
+    a = base.splitlines(True)
+    return ''.join([''.join(a[op[0]:op[1]]) if type(op) == list else op for op in ops])
+
+
+def encode_delta(base, txt):
+    """ Returns (size, format, content) for storing a text as a delta against base """
+    delta = json.dumps(make_delta(base, txt), ensure_ascii=False, separators=(',', ':'))
+    return len(txt.encode('utf-8')), TEXT_DELTA, sqlite3.Binary(zlib.compress(delta.encode('utf-8'), 6))
+
+
+def decode_delta(base, value):
+    return apply_delta(base, json.loads(zlib.decompress(value).decode('utf-8')))
+
+
+class StoredText(object):
+    """
+    A text read from the texts table. Decompressing is left until the text is
+    actually needed, since most runs only need the texts of a few revisions.
+    """
+
+    __slots__ = ('size', 'format', 'value', 'base')
+
+    def __init__(self, size, fmt, value, base=None):
+        self.size = size
+        self.format = fmt
+        self.value = value
+        self.base = base
+
+    def decode(self):
+        return decode_text(self.format, self.value)
+
+
+class TextStore(object):
+    """
+    Holds each distinct revision text once, keyed by its text_hash. Revisions refer to
+    their text and their parent's text by hash, so a text that is both the text of one
+    revision and the parent text of the next, or that belongs to several revisions
+    (like after a revert), is kept in memory and stored in the DB only once.
+
+    If `snapshots` is set, a text is stored as a delta against the text of its parent
+    revision, which may itself be a delta. Every `snapshots` revisions along a chain, the
+    full text is stored again, so no more than `snapshots` - 1 deltas need to be applied
+    to rebuild a text. Texts that are rebuilt, including the ones in between, are kept
+    for the rest of the run.
+    """
+
+    def __init__(self, snapshots=0):
+        self.snapshots = int(snapshots)
+        self.texts = {}      # hash -> unicode or StoredText
+        self.depths = {}     # hash -> number of deltas, for the texts known to be in the texts table
+
+    def __contains__(self, key):
+        return key in self.texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, txt):
+        """ Adds a text and returns its hash """
+        key = text_hash(txt)
+        if not key in self.texts:
+            self.texts[key] = txt
+        return key
+
+    def get(self, key):
+        txt = self.texts[key]
+        if isinstance(txt, StoredText):
+            if txt.format == TEXT_DELTA:
+                txt = decode_delta(self.get(txt.base), txt.value)
+            else:
+                txt = txt.decode()
+            self.texts[key] = txt
+        return txt
+
+    def get_size(self, key):
+        """ The size of a text in bytes, without decompressing it """
+        txt = self.texts[key]
+        if isinstance(txt, StoredText):
+            return txt.size
+        return len(txt.encode('utf-8'))
+
+    def load(self, cur, keys):
+        """ Reads the texts we don't already have from the DB, and the texts their deltas are based on """
+        keys = set([k for k in keys if not k in self.texts])
+        while len(keys) > 0:
+            bases = set()
+            keys = list(keys)
+            for s0 in range(0, len(keys), 500):
+                ids = keys[s0:s0+500]
+                q = 'SELECT hash, size, format, content, base, depth FROM texts WHERE hash IN (%s)' % ','.join(['?'] * len(ids))
+                for key, size, fmt, content, base, depth in cur.execute(q, ids):
+                    self.texts[key] = StoredText(size, fmt, content, base)
+                    self.depths[key] = depth
+                    if base is not None and not base in self.texts:
+                        bases.add(base)
+            keys = bases
+
+    def find_stored(self, cur, keys):
+        """ Finds which of the texts are already in the DB, without reading them """
+        keys = [k for k in set(keys) if not k in self.depths]
+        for s0 in range(0, len(keys), 500):
+            ids = keys[s0:s0+500]
+            q = 'SELECT hash, depth FROM texts WHERE hash IN (%s)' % ','.join(['?'] * len(ids))
+            for key, depth in cur.execute(q, ids):
+                self.depths[key] = depth
+
+    def encode(self, key, base):
+        """ Returns (size, format, content, base, depth) for storing a text """
+        txt = self.texts[key]
+        if base in self.texts and base in self.depths and self.depths[base] + 1 < self.snapshots:
+            txt = self.get(key)
+            row = encode_text(txt)
+            delta = encode_delta(self.get(base), txt)
+            # Small texts and rewrites are often smaller when stored in full
+            if len(delta[2]) < len(row[2]):
+                return delta + (base, self.depths[base] + 1)
+            return row + (None, 0)
+        if isinstance(txt, StoredText) and txt.format != TEXT_DELTA:
+            return txt.size, txt.format, txt.value, None, 0
+        return encode_text(self.get(key)) + (None, 0)
+
+    def save(self, cur, bases):
+        """
+        Writes the texts not already in the DB. `bases` maps the hashes of the texts to
+        save to the hash of the parent revision text, or None. Returns the number of
+        texts written.
+        """
+        if self.snapshots > 0:
+            # Texts stored earlier, possibly by another contest, are left as they are
+            self.find_stored(cur, bases.keys())
+        pending = dict([(k, b) for k, b in bases.iteritems() if not k in self.depths])
+        rows = []
+        for key in pending.keys():
+            # Follow the chain of parents that are to be saved too, so that the base
+            # of a delta is always saved before the delta. A revert makes a cycle,
+            # which is broken by storing a full text.
+            chain = []
+            seen = set()
+            k = key
+            while k in pending and not k in seen:
+                chain.append(k)
+                seen.add(k)
+                k = pending[k]
+            for k in reversed(chain):
+                base = pending.pop(k)
+                row = self.encode(k, base if self.snapshots > 0 else None)
+                self.depths[k] = row[4]
+                rows.append((k,) + row)
+        if len(rows) == 0:
+            return 0
+        cur.executemany('INSERT OR IGNORE INTO texts (hash, size, format, content, base, depth) VALUES (?,?,?,?,?,?)', rows)
+        return cur.rowcount
+
+
+def get_migrations(directory=None):
+    """ Returns a sorted list of (version, path) for the migration scripts """
+    if directory is None:
+        directory = os.path.join(STORAGE, 'migrations')
+    migrations = []
+    for filename in os.listdir(directory):
+        m = re.match(r'^(\d+)_.*\.sql$', filename)
+        if m:
+            migrations.append((int(m.group(1)), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+
+def get_commithash():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=STORAGE, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def split_statements(script):
+    """ Splits an SQL script into statements, leaving out comment lines """
+    statements = []
+    stmt = ''
+    for line in script.splitlines(True):
+        if line.strip().startswith('--'):
+            continue
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            statements.append(stmt.strip())
+            stmt = ''
+    if stmt.strip() != '':
+        raise ValueError('Incomplete SQL statement: %s' % stmt)
+    return statements
+
+
+def migrate(sql, directory=None):
+    """
+    Applies the migrations not yet recorded in the schemachanges table, in order.
+
+    Each migration runs in its own transaction together with its schemachanges row,
+    so a failing migration leaves the DB as it was. The transaction takes the write
+    lock before checking schemachanges again, so that two processes starting at the
+    same time don't both apply the same migration.
+    """
+    applied = set([row[0] for row in sql.execute('SELECT version FROM schemachanges')])
+    pending = [(v, p) for v, p in get_migrations(directory) if not v in applied]
+    if len(pending) == 0:
+        return
+
+    # Used by migration scripts that need to hash stored texts
+    sql.create_function('text_hash', 2, lambda fmt, content: text_hash(decode_text(fmt, content)))
+    sql.create_function('text_size', 2, lambda fmt, content: len(decode_text(fmt, content).encode('utf-8')))
+
+    commithash = get_commithash()
+    sql.commit()
+    isolation_level = sql.isolation_level
+    sql.isolation_level = None   # so that sqlite3 leaves the transactions to us
+    try:
+        for version, path in pending:
+            sql.execute('BEGIN IMMEDIATE')
+            try:
+                if sql.execute('SELECT version FROM schemachanges WHERE version=?', [version]).fetchone() is None:
+                    log('@ Applying DB migration %s' % os.path.basename(path))
+                    for stmt in split_statements(open(path).read().decode('utf-8')):
+                        sql.execute(stmt)
+                    sql.execute("INSERT INTO schemachanges (version, commithash, dateapplied) VALUES (?, ?, datetime('now'))",
+                                [version, commithash])
+                sql.execute('COMMIT')
+            except:
+                sql.execute('ROLLBACK')
+                raise
+    finally:
+        sql.isolation_level = isolation_level
+
+
+def vacuum(sql, policy='incremental'):
+    """
+    Gives free pages in the DB file back to the file system, and returns the number of
+    bytes reclaimed. The policy is one of
+
+      - 'incremental': only release the free pages. This is quick, but needs
+        auto_vacuum=INCREMENTAL, so the first time the DB is rebuilt to enable it.
+      - 'full': rebuild the DB, which also defragments it, but takes a while for a big DB.
+      - 'none': leave the free pages for later inserts.
+    """
+    if policy == 'none':
+        return 0
+    elif not policy in ('incremental', 'full'):
+        raise ValueError('Unknown vacuum policy: %s' % policy)
+
+    page_size = sql.execute('PRAGMA page_size').fetchone()[0]
+    pages_before = sql.execute('PRAGMA page_count').fetchone()[0]
+    sql.commit()
+    if policy == 'incremental' and sql.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        # Unlike the other pragmas, this one returns a row for each page freed
+        sql.execute('PRAGMA incremental_vacuum').fetchall()
+    else:
+        if policy == 'incremental':
+            log('@ Enabling incremental vacuum, this may take a while')
+            sql.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        sql.execute('VACUUM')
+    pages_after = sql.execute('PRAGMA page_count').fetchone()[0]
+    return (pages_before - pages_after) * page_size
+
+
+def compress_texts(sql, batchsize=1000):
+    """
+    Converts the rows in the texts table that are stored as plain text,
+    one batch at a time so that the bot can keep using the DB meanwhile.
+    """
+    cur = sql.cursor()
+    lastrow = 0
+    nconverted = 0
+    while True:
+        rows = cur.execute('SELECT rowid, content FROM texts WHERE format=? AND rowid > ? ORDER BY rowid LIMIT ?',
+                           [TEXT_PLAIN, lastrow, batchsize]).fetchall()
+        if len(rows) == 0:
+            break
+        cur.executemany('UPDATE texts SET format=?, content=? WHERE rowid=?',
+                        [encode_text(txt)[1:] + (rowid,) for rowid, txt in rows])
+        sql.commit()
+        lastrow = rows[-1][0]
+        nconverted += len(rows)
+    cur.close()
+    log('@ Compressed %d texts' % nconverted)
+
+    if nconverted > 0:
+        log('@ Reclaimed %.1f MB' % (vacuum(sql, 'full') / 1024. ** 2))
+    return nconverted
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Applies DB migrations')
+    parser.add_argument('db', help='Path to the DB')
+    parser.add_argument('--compress', action='store_true', default=False,
+                        help='Compress texts stored before compression was introduced')
+    args = parser.parse_args()
+
+    sql = connect(args.db)
+    migrate(sql)
+    if args.compress:
+        compress_texts(sql)
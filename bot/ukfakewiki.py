@@ -0,0 +1,870 @@
+#encoding=utf-8
+"""
+A local stand-in for the parts of the MediaWiki API that UKBot uses, populated with a
+synthetic contest. It's meant for load testing the full bot pipeline at many times the
+size of a real contest:
+
+    python ukfakewiki.py --config ../config/config.yml --users 500 --revisions 200
+
+prints the name of the generated contest page. Then, with a copy of the config where
+`homesite` is set to `localhost:8080` (and `othersites` removed):
+
+    python ukbot.py --config ../config/fake.yml --page "<contest page>" --simulate
+
+Supported: login, siteinfo/userinfo/tokens, list=usercontribs (also for many users at
+once), list=backlinks, prop=info|revisions|categories|links|iwlinks|pageprops, the
+links and backlinks generators, redirect resolution, action=parse (pre-save transform
+only) and action=edit.
+
+Article texts are not stored, but rebuilt from a seed when requested, so that even
+millions of revisions fit in memory. Each contest edit appends a paragraph containing
+words, references, images, links and interwiki links to an article, and some edits
+remove a stub template. Articles belong to a category tree of configurable depth, or
+to categories outside it.
+"""
+from __future__ import unicode_literals
+import sys
+import re
+import time
+import gzip
+import json
+import bisect
+import random
+import calendar
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime, time as dt_time
+from StringIO import StringIO
+
+import yaml
+import pytz
+from isoweek import Week
+
+from ukcommon import log
+
+TOKEN = '+\\'
+
+NAMESPACES = {-2: 'Medium', -1: 'Spesial', 0: '', 1: 'Diskusjon', 2: 'Bruker', 3: 'Brukerdiskusjon',
+              4: 'Wikipedia', 5: 'Wikipedia-diskusjon', 6: 'Fil', 7: 'Fildiskusjon', 10: 'Mal',
+              11: 'Maldiskusjon', 14: 'Kategori', 15: 'Kategoridiskusjon'}
+
+# Canonical names, which are accepted in addition to the local ones
+ALIASES = {'media': -2, 'special': -1, 'talk': 1, 'user': 2, 'user talk': 3, 'project': 4,
+           'file': 6, 'image': 6, 'template': 10, 'category': 14}
+
+INTERWIKI = ('en', 'sv', 'da', 'nn', 'se', 'fi', 'de')
+
+WORDS = ('og', 'i', 'det', 'som', 'en', 'på', 'er', 'av', 'for', 'til', 'med', 'har', 'ble',
+         'fra', 'den', 'var', 'et', 'ved', 'kommune', 'elva', 'fjellet', 'byen', 'området',
+         'historie', 'kirke', 'gården', 'skolen', 'veien', 'sjøen', 'øya', 'dalen', 'bygget',
+         'første', 'største', 'gamle', 'nordlige', 'sørlige', 'østre', 'vestre', 'nye',
+         'innbyggere', 'århundre', 'krigen', 'stasjonen', 'fabrikken', 'bruket', 'prestegjeld',
+         'grunnlagt', 'nedlagt', 'utvidet', 'restaurert', 'beskrevet', 'kjent', 'oppkalt',
+         'ligger', 'strekker', 'renner', 'omfatter', 'inngår', 'tilhører', 'grenser')
+
+TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def format_timestamp(ts):
+    return time.strftime(TIMEFMT, time.gmtime(ts))
+
+
+def parse_timestamp(ts):
+    if re.match(r'^\d{14}$', ts):
+        return calendar.timegm(time.strptime(ts, '%Y%m%d%H%M%S'))
+    return calendar.timegm(time.strptime(ts, TIMEFMT))
+
+
+def split_title(title):
+    """ Returns (namespace, normalized title) """
+    title = re.sub(r'[_ ]+', ' ', title).strip().lstrip(':').strip()
+    ns = 0
+    if ':' in title:
+        prefix, rest = title.split(':', 1)
+        prefix = prefix.strip().lower()
+        for n, name in NAMESPACES.iteritems():
+            if n != 0 and name.lower() == prefix:
+                ns = n
+        if prefix in ALIASES:
+            ns = ALIASES[prefix]
+        if ns != 0:
+            rest = rest.strip()
+            return ns, '%s:%s' % (NAMESPACES[ns], rest[:1].upper() + rest[1:])
+    return ns, title[:1].upper() + title[1:]
+
+
+class Revision(object):
+
+    __slots__ = ('revid', 'parentid', 'page', 'user', 'timestamp', 'comment', 'size', 'text', 'nparts', 'stub')
+
+    def __init__(self, revid, parentid, page, user, timestamp, comment):
+        self.revid = revid
+        self.parentid = parentid
+        self.page = page
+        self.user = user
+        self.timestamp = timestamp
+        self.comment = comment
+        self.size = 0
+        self.text = None     # set for saved revisions, generated revisions are rebuilt on demand
+        self.nparts = 0
+        self.stub = False
+
+    def get_text(self):
+        if self.text is not None:
+            return self.text
+        return self.page.generator.article_text(self.page, self.nparts, self.stub)
+
+
+class Page(object):
+
+    def __init__(self, pageid, ns, title):
+        self.pageid = pageid
+        self.ns = ns
+        self.title = title
+        self.revisions = []
+        self.categories = None   # category titles, or None to parse them from the text
+
+        # Generated articles
+        self.generator = None
+        self.partsizes = []      # byte size of each paragraph
+        self.footer = ''
+
+    def latest(self):
+        if len(self.revisions) == 0:
+            return None
+        return self.revisions[-1]
+
+    def get_text(self):
+        rev = self.latest()
+        if rev is None:
+            return ''
+        return rev.get_text()
+
+    def get_categories(self):
+        if self.categories is not None:
+            return self.categories
+        cats = []
+        for m in re.finditer(r'\[\[\s*(?:Kategori|Category)\s*:([^\]\|]+)', self.get_text(), flags=re.I):
+            cats.append(split_title('%s:%s' % (NAMESPACES[14], m.group(1)))[1])
+        return cats
+
+    def get_links(self):
+        links = []
+        for m in re.finditer(r'\[\[([^\]\|#]+)', self.get_text()):
+            target = m.group(1)
+            if target.startswith(':') or not ':' in target:
+                ns, target = split_title(target)
+                if target != '' and not target.split(':', 1)[0].lower() in INTERWIKI:
+                    links.append(target)
+        return links
+
+    def get_iwlinks(self):
+        return [(m.group(1), m.group(2).strip()) for m in re.finditer(r'\[\[:(%s):([^\]\|]+)' % '|'.join(INTERWIKI), self.get_text())]
+
+    def get_redirect(self):
+        rev = self.latest()
+        if rev is None or rev.text is None:
+            return None
+        m = re.match(r'\s*#(?:REDIRECT|OMDIRIGERING)\s*\[\[([^\]\|]+)', rev.text, flags=re.I)
+        if m:
+            return split_title(m.group(1))[1]
+        return None
+
+
+class FakeWiki(object):
+    """ The pages and revisions of the fake wiki, and the API operating on them """
+
+    def __init__(self, username='UKBot'):
+        self.lock = threading.RLock()
+        self.username = username
+        self.pages = {}          # title -> Page
+        self.pageids = {}        # pageid -> Page
+        self.revisions = {}      # revid -> Revision
+        self.contribs = {}       # user -> list of Revisions, in chronological order
+        self.contribtimes = {}   # user -> list of timestamps, for bisect
+        self.backlinks = None    # title -> list of Pages linking to it, built when needed
+        self.last_pageid = 0
+        self.last_revid = 0
+
+    def get_page(self, title, create=False):
+        ns, title = split_title(title)
+        if not title in self.pages and create:
+            self.last_pageid += 1
+            page = Page(self.last_pageid, ns, title)
+            self.pages[title] = page
+            self.pageids[page.pageid] = page
+        return self.pages.get(title)
+
+    def add_revision(self, page, user, timestamp, comment='', text=None):
+        """ Adds a revision to the page. The caller should set `size` (and text or nparts/stub). """
+        with self.lock:
+            self.last_revid += 1
+            parent = page.latest()
+            rev = Revision(self.last_revid, 0 if parent is None else parent.revid, page, user, timestamp, comment)
+            if text is not None:
+                rev.text = text
+                rev.size = len(text.encode('utf-8'))
+            page.revisions.append(rev)
+            self.revisions[rev.revid] = rev
+            if not user in self.contribs:
+                self.contribs[user] = []
+                self.contribtimes[user] = []
+            self.contribs[user].append(rev)
+            self.contribtimes[user].append(timestamp)
+            self.backlinks = None
+            return rev
+
+    def sort_contribs(self):
+        for user, revs in self.contribs.iteritems():
+            revs.sort(key=lambda r: (r.timestamp, r.revid))
+            self.contribtimes[user] = [r.timestamp for r in revs]
+
+    def get_backlinks(self, title):
+        with self.lock:
+            if self.backlinks is None:
+                index = {}
+                for page in self.pages.itervalues():
+                    for link in set(page.get_links()):
+                        index.setdefault(link, []).append(page)
+                self.backlinks = index
+            return self.backlinks.get(split_title(title)[1], [])
+
+    ############################################################################################
+    # API
+
+    def api(self, params, host):
+        action = params.get('action', '')
+        try:
+            if action == 'query':
+                return self.query(params, host)
+            elif action == 'login':
+                return self.login(params)
+            elif action == 'tokens':
+                return {'tokens': {'edittoken': TOKEN}}
+            elif action == 'parse':
+                return self.parse(params)
+            elif action == 'edit':
+                return self.edit(params)
+            return self.error('unknown_action', 'Unrecognized value for parameter \'action\': %s' % action)
+        except (KeyError, ValueError) as e:
+            return self.error('badparams', '%s: %s' % (e.__class__.__name__, e))
+
+    def error(self, code, info):
+        return {'error': {'code': code, 'info': info}}
+
+    def get_limit(self, params, key, default=10):
+        limit = params.get(key, str(default))
+        if limit == 'max':
+            return 500
+        return min(int(limit), 5000)
+
+    def login(self, params):
+        if not 'lgtoken' in params:
+            return {'login': {'result': 'NeedToken', 'token': 'logintoken'}}
+        self.username = params['lgname']
+        return {'login': {'result': 'Success', 'lgusername': self.username, 'lguserid': 1}}
+
+    def parse(self, params):
+        text = params.get('text', '')
+        if not 'onlypst' in params:
+            return self.error('notimplemented', 'Only the pre-save transform is supported')
+        text = re.sub(r'\{\{\s*subst:\s*([^\|\}]+)[^\}]*\}\}', lambda m: '[[%s]]' % m.group(1).strip(), text)
+        return {'parse': {'title': 'API', 'text': {'*': text}}}
+
+    def edit(self, params):
+        if params.get('token') != TOKEN:
+            return self.error('badtoken', 'Invalid token')
+        with self.lock:
+            page = self.get_page(params['title'], create=True)
+            old = page.get_text()
+            if 'appendtext' in params:
+                text = old + params['appendtext']
+            elif params.get('section') == 'new':
+                text = old
+                if 'sectiontitle' in params or 'summary' in params:
+                    text += '\n\n== %s ==\n' % params.get('sectiontitle', params.get('summary'))
+                text += params.get('text', '')
+            else:
+                text = params.get('text', '')
+            oldrev = page.latest()
+            if oldrev is not None and old == text:
+                return {'edit': {'result': 'Success', 'pageid': page.pageid, 'title': page.title, 'nochange': ''}}
+            rev = self.add_revision(page, self.username, int(time.time()), params.get('summary', ''), text=text)
+            page.categories = None
+        res = {'result': 'Success', 'pageid': page.pageid, 'title': page.title,
+               'newrevid': rev.revid, 'newtimestamp': format_timestamp(rev.timestamp)}
+        if oldrev is None:
+            res['new'] = ''
+        else:
+            res['oldrevid'] = oldrev.revid
+        return {'edit': res}
+
+    def siteinfo(self, host):
+        general = {'mainpage': 'Forside', 'base': 'http://%s/wiki/Forside' % host, 'sitename': 'Wikipedia',
+                   'generator': 'MediaWiki 1.21.0', 'case': 'first-letter', 'lang': 'nb',
+                   'server': '//%s' % host, 'script': '/w/index.php', 'scriptpath': '/w',
+                   'articlepath': '/wiki/$1', 'writeapi': '', 'timezone': 'Europe/Oslo',
+                   'time': format_timestamp(time.time())}
+        namespaces = {}
+        for n, name in NAMESPACES.iteritems():
+            namespaces[str(n)] = {'id': n, '*': name, 'case': 'first-letter'}
+        return general, namespaces
+
+    def userinfo(self):
+        return {'id': 1, 'name': self.username, 'groups': ['*', 'user', 'autoconfirmed', 'bot'],
+                'rights': ['read', 'edit', 'createpage', 'createtalk', 'writeapi', 'bot',
+                           'apihighlimits', 'noratelimit', 'editprotected', 'autoconfirmed']}
+
+    def query(self, params, host):
+        result = {}
+        q = {}
+        result['query'] = q
+
+        meta = params.get('meta', '').split('|')
+        if 'siteinfo' in meta:
+            q['general'], q['namespaces'] = self.siteinfo(host)
+        if 'userinfo' in meta:
+            q['userinfo'] = self.userinfo()
+        if 'tokens' in meta:
+            q['tokens'] = {'edittoken': TOKEN, 'csrftoken': TOKEN}
+
+        if params.get('list') == 'usercontribs':
+            self.query_usercontribs(params, result)
+        elif params.get('list') == 'backlinks':
+            limit = self.get_limit(params, 'bllimit')
+            offset = int(params.get('blcontinue', 0))
+            pages = self.get_backlinks(params['bltitle'])
+            q['backlinks'] = [{'pageid': p.pageid, 'ns': p.ns, 'title': p.title} for p in pages[offset:offset+limit]]
+            if offset + limit < len(pages):
+                result['query-continue'] = {'backlinks': {'blcontinue': str(offset + limit)}}
+
+        # Find the pages to return
+        pages = []
+        missing = []
+        if 'generator' in params:
+            pages = self.query_generator(params, result)
+        elif 'revids' in params:
+            seen = set()
+            for revid in params['revids'].split('|'):
+                rev = self.revisions.get(int(revid))
+                if rev is None:
+                    q.setdefault('badrevids', {})[revid] = {'revid': revid}
+                elif not rev.page.pageid in seen:
+                    seen.add(rev.page.pageid)
+                    pages.append(rev.page)
+        elif 'titles' in params:
+            for title in params['titles'].split('|'):
+                ns, norm = split_title(title)
+                if norm != title:
+                    q.setdefault('normalized', []).append({'from': title, 'to': norm})
+                page = self.pages.get(norm)
+                if page is not None and 'redirects' in params:
+                    target = page.get_redirect()
+                    if target is not None:
+                        q.setdefault('redirects', []).append({'from': norm, 'to': target})
+                        ns, norm = split_title(target)
+                        page = self.pages.get(norm)
+                if page is None or len(page.revisions) == 0:
+                    missing.append((ns, norm))
+                else:
+                    pages.append(page)
+
+        if len(pages) == 0 and len(missing) == 0:
+            return result
+
+        out = {}
+        for i, (ns, title) in enumerate(missing):
+            out[str(-1 - i)] = {'ns': ns, 'title': title, 'missing': ''}
+        for page in pages:
+            out[str(page.pageid)] = {'pageid': page.pageid, 'ns': page.ns, 'title': page.title}
+        q['pages'] = out
+
+        props = params.get('prop', '').split('|')
+        if 'info' in props:
+            for page in pages:
+                rev = page.latest()
+                p = out[str(page.pageid)]
+                p.update({'lastrevid': rev.revid, 'length': rev.size, 'touched': format_timestamp(rev.timestamp),
+                          'contentmodel': 'wikitext', 'protection': []})
+                if page.get_redirect() is not None:
+                    p['redirect'] = ''
+                if 'intoken' in params:
+                    p['edittoken'] = TOKEN
+                    p['starttimestamp'] = format_timestamp(time.time())
+            if 'intoken' in params:
+                for p in out.itervalues():
+                    if 'missing' in p:
+                        p['edittoken'] = TOKEN
+        if 'pageprops' in props:
+            for page in pages:
+                out[str(page.pageid)]['pageprops'] = {}
+        if 'revisions' in props:
+            self.query_revisions(params, pages, out, result)
+        if 'categories' in props:
+            self.query_categories(params, pages, out, result)
+        if 'links' in props:
+            limit = self.get_limit(params, 'pllimit')
+            for page in pages:
+                out[str(page.pageid)]['links'] = [{'ns': split_title(l)[0], 'title': l} for l in page.get_links()[:limit]]
+        if 'iwlinks' in props:
+            for page in pages:
+                out[str(page.pageid)]['iwlinks'] = [{'prefix': prefix, '*': title} for prefix, title in page.get_iwlinks()]
+
+        return result
+
+    def query_generator(self, params, result):
+        generator = params['generator']
+        if generator == 'links':
+            limit = self.get_limit(params, 'gpllimit')
+            offset = int(params.get('gplcontinue', 0))
+            titles = []
+            for title in params['titles'].split('|'):
+                page = self.pages.get(split_title(title)[1])
+                if page is not None:
+                    titles.extend(page.get_links())
+            pages = []
+            for title in titles:
+                page = self.pages.get(title)
+                if page is not None and 'redirects' in params and page.get_redirect() is not None:
+                    page = self.pages.get(page.get_redirect())
+                if page is not None and not page in pages:
+                    pages.append(page)
+            if offset + limit < len(pages):
+                result['query-continue'] = {'links': {'gplcontinue': str(offset + limit)}}
+            return pages[offset:offset+limit]
+        elif generator == 'backlinks':
+            limit = self.get_limit(params, 'gbllimit')
+            offset = int(params.get('gblcontinue', 0))
+            pages = self.get_backlinks(params['gbltitle'])
+            if offset + limit < len(pages):
+                result['query-continue'] = {'backlinks': {'gblcontinue': str(offset + limit)}}
+            return pages[offset:offset+limit]
+        raise ValueError('Unsupported generator %s' % generator)
+
+    def query_usercontribs(self, params, result):
+        users = [split_title(u)[1] for u in params['ucuser'].split('|')]
+        newer = params.get('ucdir', 'older') == 'newer'
+        start = end = None
+        if 'ucstart' in params:
+            start = parse_timestamp(params['ucstart'])
+        if 'ucend' in params:
+            end = parse_timestamp(params['ucend'])
+        lo, hi = (start, end) if newer else (end, start)
+        namespaces = None
+        if 'ucnamespace' in params:
+            namespaces = [int(n) for n in params['ucnamespace'].split('|')]
+
+        revs = []
+        for user in users:
+            times = self.contribtimes.get(user, [])
+            i0 = 0 if lo is None else bisect.bisect_left(times, lo)
+            i1 = len(times) if hi is None else bisect.bisect_right(times, hi)
+            for rev in self.contribs[user][i0:i1] if i1 > i0 else []:
+                if namespaces is None or rev.page.ns in namespaces:
+                    revs.append(rev)
+        revs.sort(key=lambda r: (r.timestamp, r.revid), reverse=not newer)
+
+        limit = self.get_limit(params, 'uclimit')
+        offset = int(params.get('uccontinue', 0))
+        contribs = []
+        for rev in revs[offset:offset+limit]:
+            c = {'userid': 2, 'user': rev.user, 'pageid': rev.page.pageid, 'revid': rev.revid,
+                 'parentid': rev.parentid, 'ns': rev.page.ns, 'title': rev.page.title,
+                 'timestamp': format_timestamp(rev.timestamp), 'comment': rev.comment, 'size': rev.size}
+            if rev.parentid == 0:
+                c['new'] = ''
+            if rev is rev.page.latest():
+                c['top'] = ''
+            contribs.append(c)
+        result['query']['usercontribs'] = contribs
+        if offset + limit < len(revs):
+            result['query-continue'] = {'usercontribs': {'uccontinue': str(offset + limit)}}
+
+    def format_revision(self, rev, rvprop):
+        r = {}
+        if 'ids' in rvprop:
+            r['revid'] = rev.revid
+            r['parentid'] = rev.parentid
+        if 'timestamp' in rvprop:
+            r['timestamp'] = format_timestamp(rev.timestamp)
+        if 'user' in rvprop:
+            r['user'] = rev.user
+        if 'comment' in rvprop:
+            r['comment'] = rev.comment
+        if 'size' in rvprop:
+            r['size'] = rev.size
+        if 'content' in rvprop:
+            r['*'] = rev.get_text()
+            r['contentformat'] = 'text/x-wiki'
+            r['contentmodel'] = 'wikitext'
+        return r
+
+    def query_revisions(self, params, pages, out, result):
+        rvprop = params.get('rvprop', 'ids|timestamp|flags|comment|user').split('|')
+        if 'revids' in params:
+            for revid in params['revids'].split('|'):
+                rev = self.revisions.get(int(revid))
+                if rev is not None:
+                    out[str(rev.page.pageid)].setdefault('revisions', []).append(self.format_revision(rev, rvprop))
+            return
+
+        # A single page, newest first unless rvdir=newer
+        if len(pages) == 0:
+            return
+        page = pages[0]
+        revs = page.revisions
+        if params.get('rvdir', 'older') != 'newer':
+            revs = revs[::-1]
+        if 'rvstartid' in params:
+            startid = int(params['rvstartid'])
+            revs = [r for r in revs if (r.revid <= startid if params.get('rvdir', 'older') != 'newer' else r.revid >= startid)]
+        limit = self.get_limit(params, 'rvlimit', 1)
+        out[str(page.pageid)]['revisions'] = [self.format_revision(rev, rvprop) for rev in revs[:limit]]
+        if limit < len(revs):
+            result['query-continue'] = {'revisions': {'rvstartid': revs[limit].revid}}
+
+    def query_categories(self, params, pages, out, result):
+        limit = self.get_limit(params, 'cllimit')
+        offset = int(params.get('clcontinue', 0))
+        cats = []
+        for page in pages:
+            for cat in page.get_categories():
+                cats.append((page, cat))
+        for page, cat in cats[offset:offset+limit]:
+            out[str(page.pageid)].setdefault('categories', []).append({'ns': 14, 'title': cat})
+        if offset + limit < len(cats):
+            result['query-continue'] = {'categories': {'clcontinue': str(offset + limit)}}
+
+
+class ContestGenerator(object):
+    """
+    Populates a FakeWiki with a contest page and the contributions of its participants.
+
+    Arguments:
+      - config: the bot config, for template and page names
+      - users: number of participants
+      - idle: number of additional participants without any contest edits
+      - revisions: number of contest edits per participant
+      - textsize: average number of bytes added by each edit
+      - initsize: average size of the existing articles before the contest
+      - edits: average number of edits by each participant on each article
+      - catdepth: depth of the contest category tree
+      - catwidth: number of subcategories of each category
+      - seed: random seed
+      - year, week: the contest week (default: the current week)
+    """
+
+    stub = 'Stubb'
+
+    def __init__(self, config, users=20, revisions=50, textsize=1000, initsize=5000, edits=5,
+                 catdepth=3, catwidth=3, seed=0, year=None, week=None, idle=0):
+        self.config = config
+        self.nusers = users
+        self.nidle = idle
+        self.nrevisions = revisions
+        self.textsize = textsize
+        self.initsize = initsize
+        self.edits = max(1, edits)
+        self.catdepth = catdepth
+        self.catwidth = catwidth
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        wiki_tz = pytz.timezone(config['wiki_timezone'])
+        if year is None or week is None:
+            year, week = datetime.now(wiki_tz).isocalendar()[:2]
+        self.year = year
+        self.week = week
+        w = Week(year, week)
+        self.start = calendar.timegm(wiki_tz.localize(datetime.combine(w.monday(), dt_time(0, 0, 0))).utctimetuple())
+        self.end = calendar.timegm(wiki_tz.localize(datetime.combine(w.sunday(), dt_time(23, 59, 59))).utctimetuple())
+
+        self.sentences = [self.make_sentence(self.rng) for i in range(1000)]
+
+    def make_sentence(self, rng):
+        words = [rng.choice(WORDS) for i in range(rng.randint(5, 18))]
+        return ' '.join(words).capitalize() + '.'
+
+    def paragraph(self, page, k):
+        """ The k'th paragraph of the page, which is the same every time it's generated """
+        rng = random.Random('%s:%d:%d' % (self.seed, page.pageid, k))
+        out = []
+        n = 0
+        target = rng.randint(self.textsize // 2, self.textsize * 3 // 2)
+        while n < target:
+            s = rng.choice(self.sentences)
+            r = rng.random()
+            if r < 0.1:
+                s += '<ref>Kilde %d, s. %d.</ref>' % (rng.randint(1, 10000), rng.randint(1, 300))
+            elif r < 0.15:
+                s += '<ref name="k%d" />' % k
+            elif r < 0.2:
+                s = '[[%s]] %s' % (rng.choice(self.titles), s)
+            elif r < 0.22:
+                s = '[[Fil:Bilde %d.jpg|mini|%s]]\n%s' % (rng.randint(1, 10000), s, s)
+            elif r < 0.25:
+                s += ' [http://example.org/%d Lenke]' % rng.randint(1, 10000)
+            elif r < 0.27:
+                s += ' ([[:%s:%s]])' % (rng.choice(INTERWIKI), rng.choice(self.titles))
+            if k == 0 and len(out) == 0:
+                s += '<ref name="k%d">Hovedkilde %d.</ref>' % (k, page.pageid)
+            elif len(out) == 0:
+                s += '<ref name="k%d">Kilde %d.</ref>' % (k, page.pageid * 1000 + k)
+            out.append(s)
+            n += len(s) + 1
+        return ' '.join(out)
+
+    def article_text(self, page, nparts, stub):
+        parts = [self.paragraph(page, k) for k in range(nparts)]
+        head = '{{%s}}\n' % self.stub if stub else ''
+        return head + '\n\n'.join(parts) + page.footer
+
+    def article_size(self, page, nparts, stub):
+        head = len(('{{%s}}\n' % self.stub).encode('utf-8')) if stub else 0
+        return head + sum(page.partsizes[:nparts]) + 2 * max(0, nparts - 1) + len(page.footer.encode('utf-8'))
+
+    def add_parts(self, page, nparts):
+        while len(page.partsizes) < nparts:
+            page.partsizes.append(len(self.paragraph(page, len(page.partsizes)).encode('utf-8')))
+
+    def add_edit(self, wiki, page, user, timestamp, comment, nparts, stub):
+        self.add_parts(page, nparts)
+        rev = wiki.add_revision(page, user, timestamp, comment)
+        rev.nparts = nparts
+        rev.stub = stub
+        rev.size = self.article_size(page, nparts, stub)
+        return rev
+
+    def make_categories(self, wiki):
+        """ Creates the category tree, and returns the leaf categories of the tree and some outside it """
+        catns = NAMESPACES[14]
+        root = 'Testtema'
+        leaves = []
+        level = [(root, None)]
+        for depth in range(self.catdepth + 1):
+            nextlevel = []
+            for name, parent in level:
+                page = wiki.get_page('%s:%s' % (catns, name), create=True)
+                page.categories = [] if parent is None else ['%s:%s' % (catns, parent)]
+                wiki.add_revision(page, 'Kategoriarbeider', self.start - 86400 * 365, '',
+                                  text=''.join(['[[%s]]\n' % c for c in page.categories]))
+                if depth == self.catdepth:
+                    leaves.append(page.title)
+                else:
+                    nextlevel.extend([('%s %d' % (name, i + 1), name) for i in range(self.catwidth)])
+            level = nextlevel
+        others = []
+        for i in range(max(1, len(leaves) // 4)):
+            page = wiki.get_page('%s:Annet %d' % (catns, i + 1), create=True)
+            page.categories = []
+            wiki.add_revision(page, 'Kategoriarbeider', self.start - 86400 * 365, '', text='')
+            others.append(page.title)
+        return root, leaves, others
+
+    def make_article(self, wiki, title, leaves, others):
+        page = wiki.get_page(title, create=True)
+        page.generator = self
+        if self.rng.random() < 0.8:
+            page.categories = [self.rng.choice(leaves)]
+        else:
+            page.categories = [self.rng.choice(others)]
+        if self.rng.random() < 0.3:
+            page.categories.append(self.rng.choice(others))
+        page.footer = '\n\n== Referanser ==\n<references />\n\n' + '\n'.join(['[[%s]]' % c for c in page.categories])
+        return page
+
+    def populate(self, wiki):
+        """ Fills the wiki, and returns the title of the contest page """
+        config = self.config
+        t0 = time.time()
+        root, leaves, others = self.make_categories(wiki)
+
+        narticles = max(1, self.nrevisions // self.edits)
+        nexisting = max(1, int(self.nusers * narticles * 0.6 / 2))
+        self.titles = ['Eksisterende artikkel %d' % (i + 1) for i in range(nexisting)]
+
+        # Existing articles, with a couple of revisions each before the contest
+        existing = []
+        initparts = max(1, self.initsize // max(1, self.textsize))
+        for title in self.titles:
+            page = self.make_article(wiki, title, leaves, others)
+            stub = self.rng.random() < 0.5
+            ts = self.start - self.rng.randint(30, 3000) * 86400
+            self.add_edit(wiki, page, 'Eksisterende bidragsyter', ts, 'Ny artikkel', max(1, initparts // 2), stub)
+            self.add_edit(wiki, page, 'Eksisterende bidragsyter', ts + 3600, 'Utvidet', initparts, stub)
+            existing.append(page)
+
+        # Contest edits. The edits are applied in chronological order, so that parent ids are right
+        now = int(time.time())
+        tmax = min(self.end, now - 60)
+        if tmax <= self.start:
+            tmax = self.start + 3600
+        events = []
+        users = ['Deltaker %d' % (i + 1) for i in range(self.nusers)]
+        newcount = 0
+        for user in users:
+            articles = []
+            for j in range(narticles):
+                if self.rng.random() < 0.4:
+                    newcount += 1
+                    articles.append(('new', 'Ny artikkel %d' % newcount))
+                else:
+                    articles.append(('existing', self.rng.choice(existing).title))
+            for j in range(self.nrevisions):
+                events.append((self.rng.randint(self.start, tmax), user, articles[j % narticles]))
+        events.sort()
+
+        for ts, user, (kind, title) in events:
+            page = wiki.get_page(title)
+            if page is None:
+                page = self.make_article(wiki, title, leaves, others)
+                self.add_edit(wiki, page, user, ts, 'Ny artikkel', 1, self.rng.random() < 0.5)
+                continue
+            rev = page.latest()
+            stub = rev.stub
+            if stub and self.rng.random() < 0.2:
+                self.add_edit(wiki, page, user, ts, 'Fjernet stubbmal', rev.nparts + 1, False)
+            else:
+                self.add_edit(wiki, page, user, ts, 'Utvidet', rev.nparts + 1, stub)
+        wiki.sort_contribs()
+
+        # The contest page and the other pages the bot reads
+        rulecfg = config['templates']['rule']
+        filtercfg = config['templates']['filter']
+        ibcfg = config['templates']['infobox']
+        commonargs = config['templates']['commonargs']
+        userns = NAMESPACES[2]
+
+        txt = '{{%s\n| %s = %d\n| %s = %d\n| %s = [[%s:Arrangør]]\n}}\n' % (ibcfg['name'], commonargs['year'], self.year,
+                                                                            commonargs['week'], self.week, ibcfg['organizer'], userns)
+        txt += 'Syntetisk konkurranse med %d deltakere og %d redigeringer per deltaker.\n\n' % (self.nusers, self.nrevisions)
+        txt += '== Regler ==\n'
+        txt += '* {{%s|%s|%s|%s=%d}}\n' % (filtercfg['name'], filtercfg['category'], root, filtercfg['maxdepth'], self.catdepth + 2)
+        for rule in [(rulecfg['new'], 10), (rulecfg['qualified'], 2), (rulecfg['byte'], 0.1, '%s=100' % rulecfg['maxpoints']),
+                     (rulecfg['word'], 0.2), (rulecfg['ref'], 1, 0.5), (rulecfg['image'], 1), (rulecfg['external_link'], 0.1),
+                     (rulecfg['templateremoval'], 10, self.stub), (rulecfg['bytebonus'], 20, 3000), (rulecfg['wordbonus'], 20, 400)]:
+            txt += '* {{%s|%s}}\n' % (rulecfg['name'], '|'.join([unicode(a) for a in rule]))
+        txt += '\n== %s ==\n' % first_match(config['contestPages']['participantsSection'])
+        users += ['Passiv deltaker %d' % (i + 1) for i in range(self.nidle)]
+        txt += ''.join(['* [[%s:%s]]\n' % (userns, u) for u in users])
+        txt += '\n== %s ==\n' % config['contestPages']['resultsSection']
+
+        title = '%s %d-%02d' % (config['pages']['base'], self.year, self.week)
+        wiki.add_revision(wiki.get_page(title, create=True), 'Arrangør', self.start - 86400, 'Ny konkurranse', text=txt)
+        wiki.add_revision(wiki.get_page(config['pages']['catignore'], create=True), 'Arrangør', self.start - 86400, '',
+                          text='<pre>\nSkjulte kategorier\n</pre>')
+        if 'awardstatus' in config:
+            wiki.add_revision(wiki.get_page(config['awardstatus']['pagename'], create=True), 'Arrangør', self.start - 86400,
+                              config['awardstatus']['wait'], text='')
+        if 'noticeboard' in config:
+            tpl = config['noticeboard']['template']
+            wiki.add_revision(wiki.get_page(config['noticeboard']['name'], create=True), 'Arrangør', self.start - 86400, '',
+                              text='{{%s|Tema|%s=1. jan|%s=%d|%s=0}}\n' % (tpl['name'], tpl['date'], commonargs['year'], self.year, commonargs['week']))
+
+        log('@ Generated %d pages and %d revisions, %d of them by %d participants, in %.1f seconds'
+            % (len(wiki.pages), len(wiki.revisions), len(events), self.nusers, time.time() - t0))
+        return title
+
+
+def first_match(pattern):
+    """ A string matching a simple section heading pattern like 'Delta[kg]ere' """
+    return re.sub(r'\[([^\]])[^\]]*\]', r'\1', pattern).replace('\\', '')
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_api(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length', 0))
+        self.handle_api(self.rfile.read(length))
+
+    def handle_api(self, query):
+        server = self.server
+        if not self.path.split('?')[0].endswith('/api.php'):
+            return self.send_body(404, 'text/plain', b'Not found')
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if server.failrate > 0 and random.random() < server.failrate:
+            return self.send_body(503, 'text/plain', b'Service unavailable', {'Retry-After': '1'})
+        params = {k.decode('utf-8'): v.decode('utf-8') for k, v in urlparse.parse_qsl(query, keep_blank_values=True)}
+        host = self.headers.getheader('Host', 'localhost')
+        body = json.dumps(server.wiki.api(params, host))
+        self.send_body(200, 'application/json; charset=utf-8', body)
+
+    def send_body(self, status, ctype, body, headers={}):
+        if 'gzip' in self.headers.getheader('Accept-Encoding', ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.iteritems():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            log('%s - %s' % (self.address_string(), format % args))
+
+
+class FakeWikiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, wiki, latency=0., failrate=0., verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.wiki = wiki
+        self.latency = latency
+        self.failrate = failrate
+        self.verbose = verbose
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serves a synthetic contest from a fake MediaWiki API, for load testing')
+    parser.add_argument('--config', nargs='?', default='config.yml', help='Config file, for template and page names')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--users', type=int, default=20, help='Number of participants')
+    parser.add_argument('--idle', type=int, default=0, help='Number of additional participants without any edits')
+    parser.add_argument('--revisions', type=int, default=50, help='Number of contest edits per participant')
+    parser.add_argument('--textsize', type=int, default=1000, help='Average number of bytes added per edit')
+    parser.add_argument('--initsize', type=int, default=5000, help='Average size of existing articles before the contest')
+    parser.add_argument('--edits', type=int, default=5, help='Average number of edits per participant per article')
+    parser.add_argument('--catdepth', type=int, default=3, help='Depth of the contest category tree')
+    parser.add_argument('--catwidth', type=int, default=3, help='Number of subcategories per category')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--year', type=int, help='Contest year (default: current)')
+    parser.add_argument('--week', type=int, help='Contest week (default: current)')
+    parser.add_argument('--latency', type=float, default=0., help='Seconds to wait before each response')
+    parser.add_argument('--failrate', type=float, default=0., help='Fraction of requests to answer with HTTP 503')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Log every request')
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, 'r'))
+
+    wiki = FakeWiki(config['account']['user'] or 'UKBot')
+    gen = ContestGenerator(config, users=args.users, revisions=args.revisions, textsize=args.textsize,
+                           initsize=args.initsize, edits=args.edits, catdepth=args.catdepth, catwidth=args.catwidth,
+                           seed=args.seed, year=args.year, week=args.week, idle=args.idle)
+    title = gen.populate(wiki)
+
+    server = FakeWikiServer((args.host, args.port), wiki, latency=args.latency, failrate=args.failrate, verbose=args.verbose)
+    log('@ Contest page: %s' % title)
+    log('@ Serving http://%s:%d/w/api.php' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
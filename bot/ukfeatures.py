@@ -0,0 +1,367 @@
+#encoding=utf-8
+"""
+Counts derived from revision texts, like the number of words or references, that the
+rules compare between a revision and its parent.
+
+A text never changes, so each feature only needs to be computed once for each text.
+The values are cached in the features table, keyed by the hash of the text (see
+ukdb.TextStore) and the name of the feature. Since a revision's parent text is the
+text of the revision before it, most texts are shared by two revisions.
+
+The extractors work on a Document, which parses the text once for all of them.
+
+Each extractor has a version. When changing how a feature is counted, bump its version,
+so that values computed by the old code are computed again.
+
+Some features are counts of things that never span more than a few lines, like images
+or templates. For those, a text is usually not counted in full, but compared with the
+text of the parent revision: only the lines that differ are counted, and the difference
+added to the count for the parent text. See count_region.
+"""
+from __future__ import unicode_literals
+import re
+import json
+import lxml
+from collections import OrderedDict
+from lxml.html import fromstring
+from mwtemplates import TemplateEditor
+from mwtextextractor import get_body_text, condition_for_lxml
+
+EXTRACTORS = {}   # name -> (version, function taking a Document)
+REGIONS = {}      # name -> (Document attribute with the lines to compare, pairs of tokens), see extractor
+
+# Self-closing tags, like <nowiki/>, that must not be taken for the opening token of a pair
+SELF_CLOSING = r'<\w+\s*/>'
+
+
+class memoized(object):
+    """ A property that is computed when first used, and then kept """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.__name__ = fn.__name__
+        self.__doc__ = fn.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self.fn(obj)
+        obj.__dict__[self.__name__] = value
+        return value
+
+
+class Document(object):
+    """
+    A text, with the parts of it that the extractors look at. Each part is computed
+    the first time an extractor asks for it, so the text is split, parsed for
+    templates and parsed for references at most once, whatever the number of
+    extractors. Only the parts are kept, not the parse trees.
+    """
+
+    def __init__(self, txt):
+        self.text = txt
+
+    @memoized
+    def lines(self):
+        return self.text.split('\n')
+
+    @memoized
+    def headings(self):
+        """ List of (line number, line) for the section headings """
+        return [(n, line) for n, line in enumerate(self.lines) if line.startswith('==')]
+
+    @memoized
+    def body_text(self):
+        return get_body_text(self.text)
+
+    @memoized
+    def template_titles(self):
+        titles = []
+        dp = TemplateEditor(self.text)
+        for node in dp.templates.doc.findall('.//template'):
+            for elem in node:
+                if elem.tag == 'title' and elem.text is not None:
+                    titles.append(elem.text)
+        return titles
+
+    @memoized
+    def ref_tags(self):
+        """ For each <ref> tag, True if it has content (a source), and False if it only refers to one """
+        try:
+            xml = fromstring(condition_for_lxml(self.text))
+            return [tag.text is not None for tag in xml.findall('.//ref')]
+        except (lxml.etree.XMLSyntaxError, lxml.etree.ParserError):
+            return []
+
+    @memoized
+    def text_without_refs(self):
+        return re.sub(r'<ref[^>]*>.*?</ref>', '', self.text, flags=re.MULTILINE)
+
+    @memoized
+    def lines_without_refs(self):
+        lines = self.text_without_refs.split('\n')
+        if len(lines) != len(self.lines):
+            # A removed reference spanned lines, so the lines no longer match those of the text
+            return None
+        return lines
+
+
+def extractor(name, version, lines=None, pairs=()):
+    """
+    Registers a feature. If `lines` is given, the feature is a count that can be found
+    for parts of the text and summed: the name of a Document attribute with the lines
+    to split the text at, and a list of (opening, closing) tokens, like ('{{', '}}'),
+    that must be balanced in each part. Such a count is an int, or a dict of ints.
+    """
+    def register(fn):
+        EXTRACTORS[name] = (version, fn)
+        if lines is not None:
+            REGIONS[name] = (lines, re.compile('|'.join([SELF_CLOSING] + [re.escape(tok) for pair in pairs for tok in pair])),
+                             dict([(tok, (n, sign)) for n, pair in enumerate(pairs) for tok, sign in zip(pair, (1, -1))]))
+        return fn
+    return register
+
+
+def balanced_lines(lines, pattern, tokens, reverse=False):
+    """
+    Returns the largest n such that the first n lines (or the last n, if `reverse`) have
+    balanced tokens, with no closing token before its opening token.
+    """
+    if len(tokens) == 0:
+        return len(lines)
+    depth = [0] * len(tokens)
+    safe = 0
+    seq = reversed(lines) if reverse else lines
+    for n, line in enumerate(seq):
+        found = pattern.findall(line)
+        if reverse:
+            found.reverse()
+        for tok in found:
+            if not tok in tokens:
+                # a self-closing tag
+                continue
+            i, sign = tokens[tok]
+            depth[i] += -sign if reverse else sign
+            if depth[i] < 0:
+                return safe
+        if not any(depth):
+            safe = n + 1
+    return safe
+
+
+def count_region(name, base, doc, base_value):
+    """
+    Finds a feature of the text of `doc` from its value for the text of `base`, by only
+    counting the lines that differ between them. The lines that differ are widened until
+    the lines before and after them have balanced tokens, so that no reference, template
+    or link is split. Returns None if the lines can not be compared, and the text must
+    be counted in full.
+    """
+    attr, pattern, tokens = REGIONS[name]
+    a = getattr(base, attr)
+    b = getattr(doc, attr)
+    if a is None or b is None:
+        return None
+
+    # Lines common to the start and the end of both texts
+    n = min(len(a), len(b))
+    start = 0
+    while start < n and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < n - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+
+    start = balanced_lines(a[:start], pattern, tokens)
+    end = balanced_lines(a[len(a) - end:], pattern, tokens, reverse=True)
+    if start == 0 and end == 0:
+        return None
+
+    # The lines that differ must be balanced themselves, or they could open something,
+    # like a comment, that hides what comes after them
+    for lines in (a[start:len(a) - end], b[start:len(b) - end]):
+        if balanced_lines(lines, pattern, tokens) != len(lines):
+            return None
+
+    fn = EXTRACTORS[name][1]
+    removed = fn(Document('\n'.join(base.lines[start:len(a) - end])))
+    added = fn(Document('\n'.join(doc.lines[start:len(b) - end])))
+
+    if isinstance(base_value, dict):
+        value = dict(base_value)
+        for k, c in removed.iteritems():
+            value[k] = value.get(k, 0) - c
+        for k, c in added.iteritems():
+            value[k] = value.get(k, 0) + c
+        if any([c < 0 for c in value.itervalues()]):
+            return None
+        return dict([(k, c) for k, c in value.iteritems() if c != 0])
+
+    value = base_value - removed + added
+    if value < 0:
+        return None
+    return value
+
+
+@extractor('words', 1)
+def count_words(doc):
+    return len(doc.body_text.split())
+
+
+@extractor('sources', 1)
+def count_sources(doc):
+    """ Returns [sources, reference pointers] """
+
+    # Count all <ref> tags
+    s1 = doc.ref_tags.count(True)   # kilder
+    r1 = doc.ref_tags.count(False)  # kildehenvisninger
+
+    # Count list item under section heading "Kilder" or "Kjelder".
+    # The heading ending such a section is not checked itself.
+    end = -1
+    for n, heading in doc.headings:
+        if n > end and re.match('==[\s]*(Kilder|Kjelder|Gáldut)[\s]*==', heading):
+            end = len(doc.lines)
+            for m in range(n + 1, len(doc.lines)):
+                if re.match(r'==', doc.lines[m]):
+                    end = m
+                    break
+                if re.match(r'\*', doc.lines[m]):
+                    s1 += 1
+
+    return [s1, r1]
+
+
+@extractor('images', 1, lines='lines')
+def count_images(doc):
+    return len(re.findall(r'(?:\.svg|\.png|\.jpg|\.jpeg|\.gif|\.tiff)', doc.text, flags=re.IGNORECASE))
+
+
+@extractor('extlinks', 1, lines='lines_without_refs', pairs=[('[', ']')])
+def count_external_links(doc):
+    # fjern referanser først, så vi ikke teller lenker i referanser
+    return len(re.findall(r'(?<!\[)\[[^\[\] ]+ [^\[\]]+\](?!])', doc.text_without_refs))
+
+
+@extractor('templates', 1, lines='lines',
+           pairs=[('{{', '}}'), ('[[', ']]'), ('<!--', '-->'), ('<nowiki', '</nowiki'), ('<pre', '</pre')])
+def count_templates(doc):
+    """ Returns a dict mapping template names, as written, to the number of uses """
+    counts = {}
+    for title in doc.template_titles:
+        counts[title] = counts.get(title, 0) + 1
+    return counts
+
+
+@extractor('refsectionfi', 1)
+def has_ref_section_fi(doc):
+    for n, heading in doc.headings:
+        if re.match('==(=)?[\s]*(Lähteet|Viitteet)[\s]*(=?)==', heading):
+            return True
+    return False
+
+
+@extractor('redirect', 1)
+def is_redirect(doc):
+    return bool(re.match(r'#(OMDIRIGERING|REDIRECT)', doc.text))
+
+
+def extract(task):
+    """
+    Computes features of a text. Takes and returns small tuples, so that it can be
+    run in a multiprocessing.Pool: (key, text, names) in, (key, {name: value}) out.
+    """
+    key, txt, names = task
+    doc = Document(txt)
+    return key, dict([(name, EXTRACTORS[name][1](doc)) for name in names])
+
+
+class FeatureCache(object):
+    """
+    Feature values for the texts in a TextStore, read from and written to the features table.
+    """
+
+    # Number of Documents to keep. The features of a text are usually asked for one
+    # after another, so only the last few are likely to be needed again.
+    keep_documents = 32
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.values = {}   # (hash, name) -> value
+        self.new = set()   # (hash, name) computed in this run, not yet saved
+        self.documents = OrderedDict()   # hash -> Document, least recently used first
+
+    def get_document(self, key):
+        if key in self.documents:
+            doc = self.documents.pop(key)
+        elif key is None:
+            doc = Document('')
+        else:
+            doc = Document(self.texts.get(key))
+        self.documents[key] = doc
+        if len(self.documents) > self.keep_documents:
+            self.documents.popitem(last=False)
+        return doc
+
+    def get(self, key, name, base=None):
+        """
+        Returns the feature of the text with hash `key`, or of the empty text if `key` is None.
+        `base` is the hash of a similar text, usually the text of the parent revision, that
+        the text is compared with if the feature can be counted by region, see count_region.
+        """
+        k = (key, name)
+        if not k in self.values:
+            value = None
+            if name in REGIONS and key is not None and base is not None and base != key:
+                value = count_region(name, self.get_document(base), self.get_document(key),
+                                     self.get(base, name))
+            if value is None:
+                value = EXTRACTORS[name][1](self.get_document(key))
+            self.values[k] = value
+            if key is not None:
+                # The empty text is not in the texts table, so its features are not stored
+                self.new.add(k)
+        return self.values[k]
+
+    def compute(self, keys, names, pool):
+        """
+        Computes the features not already known for the texts, in the processes of `pool`.
+        Texts are sent to the processes one by one, largest first, so that they finish at
+        about the same time. Features that can be counted by region are left out, since
+        counting the lines that differ is cheaper than sending the text to a process.
+        """
+        names = [name for name in names if not name in REGIONS]
+        tasks = []
+        for key in set(keys):
+            if key is None:
+                continue
+            missing = [name for name in names if not (key, name) in self.values]
+            if len(missing) > 0:
+                tasks.append((self.texts.get_size(key), key, missing))
+        tasks.sort(reverse=True)
+        tasks = [(key, self.texts.get(key), missing) for size, key, missing in tasks]
+        for key, values in pool.imap_unordered(extract, tasks):
+            for name, value in values.iteritems():
+                self.values[(key, name)] = value
+                self.new.add((key, name))
+        return len(tasks)
+
+    def load(self, cur, keys):
+        """ Reads the cached features of the texts, leaving out those computed by an older extractor """
+        keys = list(set([k for k in keys if k is not None]))
+        for s0 in range(0, len(keys), 500):
+            ids = keys[s0:s0+500]
+            q = 'SELECT hash, name, version, value FROM features WHERE hash IN (%s)' % ','.join(['?'] * len(ids))
+            for key, name, version, value in cur.execute(q, ids):
+                if name in EXTRACTORS and EXTRACTORS[name][0] == version and not (key, name) in self.values:
+                    self.values[(key, name)] = json.loads(value)
+
+    def save(self, cur):
+        """ Writes the features computed since the last save. Returns the number written. """
+        rows = [(key, name, EXTRACTORS[name][0], json.dumps(self.values[(key, name)]))
+                for key, name in self.new]
+        self.new = set()
+        if len(rows) == 0:
+            return 0
+        cur.executemany('INSERT OR REPLACE INTO features (hash, name, version, value) VALUES (?,?,?,?)', rows)
+        return cur.rowcount
@@ -22,6 +22,9 @@ class CategoryLoopError(Exception):
 
 class Filter(object):
 
+    # Revision data needed by the filter, in addition to ids and sizes. See Rule.needs
+    needs = ()
+
     def __init__(self, verbose):
         self.verbose = verbose
 
@@ -85,6 +88,8 @@ class Filter(object):
 class TemplateFilter(Filter):
     """ Filters articles that had any of a given set of templates (or their aliases) at a point"""
 
+    needs = ('parenttext',)
+
     def __init__(self, verbose, templates, aliases=[]):
         Filter.__init__(self, verbose)
         templates.extend([a for a in aliases])
@@ -349,6 +354,8 @@ class ByteFilter(Filter):
 class NewPageFilter(Filter):
     """Filters new articles"""
 
+    needs = ('newpagetext',)
+
     def __init__(self, verbose):
         Filter.__init__(self, verbose)
 
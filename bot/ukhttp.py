@@ -0,0 +1,387 @@
+#encoding=utf-8
+from __future__ import unicode_literals
+import os
+import time
+import errno
+import random
+import socket
+import gzip
+import json
+import atexit
+import threading
+import httplib
+import urllib
+import urllib2
+import urlparse
+import cookielib
+from datetime import datetime
+from StringIO import StringIO
+from mwclient import errors
+from ukcommon import log
+
+
+class Response(object):
+    """ A response that has been read in full, with the interface mwclient expects """
+
+    def __init__(self, status, headers, message, body):
+        """
+        Arguments:
+          - status: (int) HTTP status code
+          - headers: (dict) lowercased header names mapped to values
+          - message: (httplib.HTTPMessage) the original headers, used by cookielib
+          - body: (str) the decompressed response body
+        """
+        self.status = status
+        self.headers = headers
+        self.msg = message
+        self.body = StringIO(body)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def info(self):
+        return self.msg
+
+    def read(self, *args):
+        return self.body.read(*args)
+
+
+class UnsafeRequestError(errors.MwClientError):
+    """
+    Raised when a request that changes the wiki failed with a 5xx response, so that it
+    is not known whether it was carried out. Unlike HTTPStatusError, mwclient does not
+    catch it and send the request again.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe replacement for mwclient's HTTPPool, that
+
+      - keeps up to `connections` persistent connections to each host, which is also
+        the maximum number of concurrent requests to each host,
+      - asks for gzip compressed responses,
+      - adds maxlag to API requests, and
+      - retries when the database is lagged, on 429 and 5xx responses and on connection
+        errors. We wait for Retry-After if given, or else for an exponentially increasing
+        time, with some random jitter so that parallel threads don't retry in lockstep.
+        Requests that change the wiki, like edits, are only retried when the server
+        refused them (lag, 429), since it may have carried out a request that failed
+        later, and retrying would then do it twice. When they get a 5xx response,
+        UnsafeRequestError is raised rather than HTTPStatusError, which mwclient would
+        retry.
+      - retries idempotent requests at once, on a new connection, if an idle connection
+        was closed by the server.
+
+    All connections share the same cookies, and thus the same login session.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+    unsafe_actions = ('edit', 'upload', 'move', 'delete', 'emailuser')
+
+    def __init__(self, useragent, connections=4, retries=8, maxlag=5, backoff=2., timeout=60):
+        self.useragent = useragent
+        self.connections = int(connections)
+        self.retries = int(retries)
+        self.maxlag = maxlag
+        self.backoff = float(backoff)
+        self.timeout = timeout
+
+        self.cookiejar = cookielib.CookieJar()
+        self.cookies = {}  # not used, but mwclient expects it to exist
+
+        self.lock = threading.Lock()
+        self.idle = {}     # (scheme, host) -> list of idle connections
+        self.slots = {}    # (scheme, host) -> semaphore limiting concurrent requests
+
+    def get_slot(self, key):
+        with self.lock:
+            if not key in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.connections)
+            return self.slots[key]
+
+    def get_connection(self, key):
+        """ Returns (connection, whether it has been used before) """
+        with self.lock:
+            if len(self.idle.get(key, [])) > 0:
+                return self.idle[key].pop(), True
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def put_connection(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def get_wait(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                wait = self.backoff
+        else:
+            wait = min(self.backoff * 2 ** attempt, 120.)
+        return wait * random.uniform(0.75, 1.5)
+
+    def is_idempotent(self, method, path, data):
+        """ Whether the request can be sent again without changing the wiki twice """
+        if method != 'POST':
+            return True
+        if not isinstance(data, basestring):
+            return False
+        params = urlparse.parse_qs(path.partition('?')[2])
+        params.update(urlparse.parse_qs(data))
+        return not any([a in self.unsafe_actions for a in params.get('action', [])])
+
+    def is_stale(self, error):
+        """ Whether the error is what we get when the server has closed an idle connection """
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+    def request(self, method, host, path, headers=None, data=None):
+        scheme = 'http'
+        if type(host) is tuple:
+            scheme, host = host
+        key = (scheme, host)
+        idempotent = self.is_idempotent(method, path, data)
+
+        headers = dict(headers or {})
+        headers['User-Agent'] = self.useragent
+        headers['Accept-Encoding'] = 'gzip'
+        if isinstance(data, basestring) and self.maxlag and path.endswith('api.php') and not 'maxlag=' in data:
+            data += '&maxlag=%d' % self.maxlag
+
+        url = '%s://%s%s' % (scheme, host, path)
+        slot = self.get_slot(key)
+        attempt = 0
+        while True:
+
+            req = urllib2.Request(url)
+            self.cookiejar.add_cookie_header(req)
+            if req.has_header('Cookie'):
+                headers['Cookie'] = req.get_header('Cookie')
+
+            error = None
+            slot.acquire()
+            try:
+                conn, reused = self.get_connection(key)
+                try:
+                    conn.request(method, path, data, headers)
+                    res = conn.getresponse()
+                    body = res.read()
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    stale = reused and self.is_stale(e)
+                    if not idempotent or (attempt == self.retries and not stale):
+                        raise
+                    error = e
+                else:
+                    if res.will_close:
+                        conn.close()
+                    else:
+                        self.put_connection(key, conn)
+            finally:
+                slot.release()
+
+            if error is not None:
+                if stale:
+                    # The server closed the connection while it was idle, without
+                    # handling the request, so try again on a new connection
+                    continue
+                wait = self.get_wait(attempt)
+                log('  !! %s %s failed: %s. Retrying in %.1f seconds' % (method, host, error, wait))
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+            response_headers = dict(res.getheaders())
+            if response_headers.pop('content-encoding', None) == 'gzip':
+                body = gzip.GzipFile(fileobj=StringIO(body)).read()
+            response = Response(res.status, response_headers, res.msg, body)
+            self.cookiejar.extract_cookies(response, req)
+
+            lag = response.getheader('X-Database-Lag')
+            refused = lag is not None or res.status == 429
+            if (refused or (res.status in self.retry_statuses and idempotent)) and attempt < self.retries:
+                wait = self.get_wait(attempt, response.getheader('Retry-After'))
+                if lag is not None:
+                    log('  !! %s: database lag is %s seconds. Retrying in %.1f seconds' % (host, lag, wait))
+                else:
+                    log('  !! %s: got HTTP %d. Retrying in %.1f seconds' % (host, res.status, wait))
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+            if res.status in (301, 302, 303, 307):
+                raise errors.HTTPRedirectError(res.status, response)
+            elif 500 <= res.status <= 599 and not (refused or idempotent):
+                raise UnsafeRequestError(res.status, response)
+            elif res.status != 200:
+                raise errors.HTTPStatusError(res.status, response)
+            return response
+
+    def get(self, host, path, headers=None):
+        return self.request('GET', host, path, headers)
+
+    def post(self, host, path, headers=None, data=None):
+        return self.request('POST', host, path, headers, data)
+
+
+class CassetteError(Exception):
+    """Raised when replaying a request that was not recorded"""
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg.encode('utf-8')
+
+
+class Cassette(object):
+    """
+    Stores HTTP responses on disk, so that a run can be replayed later without network access.
+
+    Responses are keyed by the request method, host, path and parameters, leaving out
+    parameters that vary between runs (tokens, passwords, maxlag). If the same request is
+    made several times, the responses are replayed in the order they were recorded, and
+    the last one is repeated.
+
+    Each host gets a gzipped file with one JSON record per line.
+    """
+
+    ignored_params = ('lgpassword', 'lgtoken', 'token', 'maxlag')
+
+    def __init__(self, directory, host):
+        if type(host) is tuple:
+            host = host[1]
+        self.filename = os.path.join(directory, host.replace(':', '_') + '.jsonl.gz')
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.played = {}
+        self.file = None
+
+    def get_key(self, method, host, path, data=None):
+        if type(host) is tuple:
+            host = host[1]
+        path, _, query = path.partition('?')
+        params = urlparse.parse_qsl(query, keep_blank_values=True)
+        if isinstance(data, basestring):
+            params.extend(urlparse.parse_qsl(data, keep_blank_values=True))
+        params = sorted([(k, v) for k, v in params if not k in self.ignored_params])
+        return '%s %s%s?%s' % (method, host, path, urllib.urlencode(params))
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            raise CassetteError('Cassette %s not found' % self.filename)
+        f = gzip.open(self.filename, 'rb')
+        try:
+            for line in f:
+                rec = json.loads(line)
+                self.responses.setdefault(rec['key'], []).append(rec)
+        except (IOError, EOFError):
+            # The recording run was interrupted before the file was closed
+            pass
+        f.close()
+        log('@ Loaded %d responses from %s' % (sum([len(r) for r in self.responses.itervalues()]), self.filename))
+
+    def record(self, key, response):
+        headers = {k: v for k, v in response.headers.iteritems() if k != 'set-cookie'}
+        rec = {'key': key, 'status': response.status, 'headers': headers,
+               'body': response.body.getvalue().decode('latin-1')}  # latin-1 maps bytes 1:1 to unicode
+        line = json.dumps(rec, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file is None:
+                directory = os.path.dirname(self.filename)
+                if directory != '' and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.file = gzip.open(self.filename, 'wb')
+                atexit.register(self.close)
+            self.file.write(line)
+            self.file.flush()
+
+    def play(self, key):
+        with self.lock:
+            if not key in self.responses:
+                raise CassetteError('No recorded response for %s' % key)
+            n = self.played.get(key, 0)
+            self.played[key] = n + 1
+            rec = self.responses[key][min(n, len(self.responses[key]) - 1)]
+        return Response(rec['status'], rec['headers'], None, rec['body'].encode('latin-1'))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Clock(object):
+    """
+    The wall clock of a run. The bot decides what to ask for based on the time (whether
+    a full resync is due, whether the contest has ended, ...), so a replay must see the
+    same time as the recording. When recording, the time the run started is saved in
+    the cassette directory, and when replaying, the clock is shifted to start at that time.
+    Each recording needs a directory of its own.
+    """
+
+    filename = 'clock.json'
+
+    def __init__(self, record=None, replay=None):
+        self.offset = 0.
+        if replay is not None:
+            filename = os.path.join(replay, self.filename)
+            if not os.path.isfile(filename):
+                raise CassetteError('Clock %s not found' % filename)
+            with open(filename, 'r') as f:
+                self.offset = json.load(f)['start'] - time.time()
+            log('@ Replaying with the clock of the recording, shifted by %.f seconds' % self.offset)
+        elif record is not None:
+            filename = os.path.join(record, self.filename)
+            if os.path.isfile(filename):
+                # The cassettes would mix the responses of two runs
+                raise CassetteError('%s already holds a recording' % record)
+            if not os.path.isdir(record):
+                os.makedirs(record)
+            with open(filename, 'w') as f:
+                json.dump({'start': time.time()}, f)
+
+    def time(self):
+        """ Like time.time() """
+        return time.time() + self.offset
+
+    def now(self):
+        """ Like datetime.now() """
+        return datetime.fromtimestamp(self.time())
+
+
+class RecordingPool(ConnectionPool):
+    """ A ConnectionPool that records all responses to a Cassette """
+
+    def __init__(self, cassette, *args, **kwargs):
+        ConnectionPool.__init__(self, *args, **kwargs)
+        self.cassette = cassette
+
+    def request(self, method, host, path, headers=None, data=None):
+        response = ConnectionPool.request(self, method, host, path, headers, data)
+        self.cassette.record(self.cassette.get_key(method, host, path, data), response)
+        return response
+
+
+class ReplayPool(ConnectionPool):
+    """ A ConnectionPool that serves responses from a Cassette, without network access """
+
+    def __init__(self, cassette, *args, **kwargs):
+        ConnectionPool.__init__(self, *args, **kwargs)
+        self.cassette = cassette
+        self.cassette.load()
+
+    def request(self, method, host, path, headers=None, data=None):
+        response = self.cassette.play(self.cassette.get_key(method, host, path, data))
+        if response.status in (301, 302, 303, 307):
+            raise errors.HTTPRedirectError(response.status, response)
+        elif response.status != 200:
+            raise errors.HTTPStatusError(response.status, response)
+        return response
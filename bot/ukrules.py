@@ -1,20 +1,46 @@
 #encoding=utf-8
 from __future__ import unicode_literals
 import re
-from lxml.html import fromstring
-import lxml
-from mwtemplates import TemplateEditor
-from mwtextextractor import condition_for_lxml
 from ukcommon import init_localization
 
 t, _ = init_localization()
 
+# Points given by earlier runs are reused as long as the rules are the same, see
+# User.analyze. Bump when changing how a rule gives points.
+SCORING_VERSION = 1
+
 
 class Rule(object):
 
+    # Revision data needed by the rule, in addition to ids and sizes, which are always fetched:
+    #   'text'        : the text of every revision
+    #   'parenttext'  : the text of every parent revision
+    #   'newpagetext' : the text of revisions creating a new page
+    needs = ()
+
+    # Counts derived from the texts that the rule uses, see ukfeatures. They are found with
+    # Revision.feature and Revision.parentfeature, and this list is only used to compute
+    # them in advance, in parallel.
+    features = ()
+
+    # Attributes holding statistics or caches built up while testing revisions,
+    # rather than parameters of the rule
+    state = ()
+
     def __init__(self, key):
         self.key = key
 
+    def get_fingerprint(self):
+        """ Identifies the rule and its parameters, see User.analyze """
+        return [type(self).__name__] + sorted([[k, v] for k, v in vars(self).iteritems() if not k in self.state])
+
+    def tally(self, rev):
+        """
+        Updates the statistics kept by the rule for a revision. Called by test, and by
+        User.analyze for revisions given the points stored in an earlier run instead.
+        """
+        pass
+
     def iszero(self, f):
         f = float(f)
         return (f > -0.1 and f < 0.1)
@@ -27,41 +53,47 @@ class Rule(object):
         if pmax > 0.0 and self.iszero(ab - pmax):
             # we have reached max
             if points < 0.0 and ab_raw + points < pmax:
-                rev.points.append([pmax - ab_raw - points, ptype, txt, points])
+                rev.add_points(pmax - ab_raw - points, ptype, txt, points)
             else:
-                rev.points.append([0.0, ptype, txt, points])
+                rev.add_points(0.0, ptype, txt, points)
 
         elif pmax > 0.0 and ab + points > pmax:
             # reaching max
-            rev.points.append([pmax - ab, ptype, txt + ' &gt; ' + _('max'), points])
+            rev.add_points(pmax - ab, ptype, txt + ' &gt; ' + _('max'), points)
 
         #elif not self.iszero(revpoints):
         else:
             if self.iszero(points) and not include_zero:
                 return
-            rev.points.append([points, ptype, txt, points])
+            rev.add_points(points, ptype, txt, points)
 
 
 class NewPageRule(Rule):
 
+    needs = ('newpagetext',)
+    features = ('redirect',)
+
     def __init__(self, key, points):
         Rule.__init__(self, key)
         self.points = float(points)
 
     def test(self, rev):
         if rev.new and not rev.redirect:
-            rev.points.append([self.points, 'newpage', _('new page')])
+            rev.add_points(self.points, 'newpage', _('new page'))
 
 
 class RedirectRule(Rule):
 
+    needs = ('newpagetext',)
+    features = ('redirect',)
+
     def __init__(self, key, points):
         Rule.__init__(self, key)
         self.points = float(points)
 
     def test(self, rev):
         if rev.new and rev.redirect:
-            rev.points.append([self.points, 'redirect', _('redirect')])
+            rev.add_points(self.points, 'redirect', _('redirect'))
 
 # class StubRule(Rule):
 
@@ -88,6 +120,10 @@ class RedirectRule(Rule):
 
 class TemplateRemovalRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('templates', 'redirect')
+    state = ('total',)
+
     def __init__(self, key, points, template, aliases=[]):
         Rule.__init__(self, key)
         self.points = float(points)
@@ -108,37 +144,27 @@ class TemplateRemovalRule(Rule):
                 return True
         return False
 
-    def templatecount(self, text):
-        """ Checks if a given text has the template"""
-
-        dp = TemplateEditor(text)
-        tc = 0
-        for node in dp.templates.doc.findall('.//template'):
-            for elem in node:
-                if elem.tag == 'title':
-                    if self.testtpl(elem.text):
-                        tc += 1
- #       for tpl in dp.templates._templates():
-            #if self.testtpl(tpl.name) or tpl.name in self.aliases:
-#            tc += 1
-        #for tpl in dp.templates:
-            #tc += len(tpl)
-        #    pass
-        #     if self.testtpl(tname) or tname in self.aliases:
-        #         tc += len(templ)
-        # del dp
-        return tc
+    def templatecount(self, templates):
+        """ Counts the uses of the template, given the template counts of a text """
+        return sum([n for name, n in templates.iteritems() if self.testtpl(name)])
 
-    def test(self, rev):
+    def get_removed(self, rev):
         if rev.redirect or rev.parentredirect:
             # skip redirects
-            return
-        pt = self.templatecount(rev.parenttext)
-        ct = self.templatecount(rev.text)
-        if ct < pt:
-            rev.points.append([(pt - ct) * self.points, 'templateremoval',
-                              _('removal of {{tl|%(template)s}}') % {'template': self.template}])
-            self.total += (pt - ct)
+            return 0
+        pt = self.templatecount(rev.parentfeature('templates'))
+        ct = self.templatecount(rev.feature('templates'))
+        return max(pt - ct, 0)
+
+    def tally(self, rev):
+        self.total += self.get_removed(rev)
+
+    def test(self, rev):
+        removed = self.get_removed(rev)
+        if removed > 0:
+            rev.add_points(removed * self.points, 'templateremoval',
+                          _('removal of {{tl|%(template)s}}') % {'template': self.template})
+        self.tally(rev)
 
 
 class QualiRule(Rule):
@@ -149,7 +175,7 @@ class QualiRule(Rule):
 
     def test(self, rev):
         if self.iszero(rev.article.get_points('quali')):
-            rev.points.append([self.points, 'quali', _('qualified')])
+            rev.add_points(self.points, 'quali', _('qualified'))
 
 
 class ByteRule(Rule):
@@ -169,6 +195,9 @@ class ByteRule(Rule):
 
 class WordRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('words',)
+
     def __init__(self, key, points, maxpoints=-1):
         Rule.__init__(self, key)
         self.points = float(points)
@@ -186,18 +215,18 @@ class WordRule(Rule):
 
 class ImageRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('images',)
+
     def __init__(self, key, points, maxpoints=-1):
         Rule.__init__(self, key)
         self.points = float(points)
         self.maxpoints = float(maxpoints)
 
-    def get_imagecount(self, txt):
-        return len(re.findall(r'(?:\.svg|\.png|\.jpg|\.jpeg|\.gif|\.tiff)', txt, flags=re.IGNORECASE))
-
     def test(self, rev):
 
-        nimages = self.get_imagecount(rev.text)
-        nimages_p = self.get_imagecount(rev.parenttext)
+        nimages = rev.feature('images')
+        nimages_p = rev.parentfeature('images')
         imgs = nimages - nimages_p
 
         if imgs > 0:
@@ -207,19 +236,18 @@ class ImageRule(Rule):
 
 class ExternalLinkRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('extlinks',)
+
     def __init__(self, key, points, maxpoints=-1):
         Rule.__init__(self, key)
         self.points = float(points)
         self.maxpoints = float(maxpoints)
 
-    def get_linkcount(self, txt):
-        txt = re.sub(r'<ref[^>]*>.*?</ref>', '', txt, flags=re.MULTILINE)  # fjern referanser først, så vi ikke teller lenker i referanser
-        return len(re.findall(r'(?<!\[)\[[^\[\] ]+ [^\[\]]+\](?!])', txt))
-
     def test(self, rev):
 
-        nlinks = self.get_linkcount(rev.text)
-        nlinks_p = self.get_linkcount(rev.parenttext)
+        nlinks = rev.feature('extlinks')
+        nlinks_p = rev.parentfeature('extlinks')
         links = nlinks - nlinks_p
 
         if links > 0:
@@ -229,6 +257,10 @@ class ExternalLinkRule(Rule):
 
 class RefRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('sources',)
+    state = ('totalsources',)
+
     def __init__(self, key, sourcepoints, refpoints):
         """
         sourcepoints: points for adding new sources
@@ -239,50 +271,20 @@ class RefRule(Rule):
         self.refpoints = float(refpoints)
         self.totalsources = 0
 
-    def get_sourcecount(self, txt):
-
-        s1 = 0  # kilder
-        r1 = 0  # kildehenvisninger
-
-        # Count all <ref> tags
-        try:
-            xml = fromstring(condition_for_lxml(txt))
-            allref1 = xml.findall('.//ref')
-            for tag in allref1:
-                if tag.text is None:
-                    r1 += 1
-                else:
-                    s1 += 1
-            del xml
-        except lxml.etree.XMLSyntaxError:
-            s1 = 0
-            r1 = 0
-
-        # Count list item under section heading "Kilder" or "Kjelder"
-        refsection = False
-        for line in txt.split('\n'):
-            if refsection:
-                if re.match(r'==', line):
-                    refsection = False
-                    continue
-                if re.match(r'\*', line):
-                    s1 += 1
-            elif re.match('==[\s]*(Kilder|Kjelder|Gáldut)[\s]*==', line):
-                refsection = True
-
-        return s1, r1
+    def tally(self, rev):
+        self.totalsources += rev.feature('sources')[0] - rev.parentfeature('sources')[0]
 
     def test(self, rev):
 
-        s1, r1 = self.get_sourcecount(rev.parenttext)
-        s2, r2 = self.get_sourcecount(rev.text)
+        s1, r1 = rev.parentfeature('sources')
+        s2, r2 = rev.feature('sources')
 
         #print rev.article.name,len(allref1), len(allref2)
 
         sources_added = s2 - s1
         refs_added = r2 - r1
 
-        self.totalsources += sources_added
+        self.tally(rev)
 
         if sources_added > 0 or refs_added > 0:
             p = 0.
@@ -295,82 +297,95 @@ class RefRule(Rule):
                 s.append(t.ungettext('one reference pointer', '%(num)d reference pointers', refs_added) % {'num': refs_added})
             txt = ', '.join(s)
 
-            rev.points.append([p, 'ref', txt])
+            rev.add_points(p, 'ref', txt)
 
 class RefSectionFiRule(Rule):
 
+    needs = ('text', 'parenttext')
+    features = ('refsectionfi',)
+    state = ('totalrefsectionsadded',)
+
     def __init__(self, key, points):
         Rule.__init__(self, key)
         self.points = float(points)
         self.totalrefsectionsadded = 0
 
-    def has_ref_section(self, txt):
+    def added_ref_section(self, rev):
+        return not rev.parentfeature('refsectionfi') and rev.feature('refsectionfi')
 
-        refsec = False
-
-        # Count list item under section heading "Kilder" or "Kjelder"
-        refsection = False
-        for line in txt.split('\n'):
-            if re.match('==(=)?[\s]*(Lähteet|Viitteet)[\s]*(=?)==', line):
-                refsection = True
-
-        return refsection
+    def tally(self, rev):
+        if self.added_ref_section(rev):
+            self.totalrefsectionsadded += 1
 
     def test(self, rev):
 
-        r1 = self.has_ref_section(rev.parenttext)
-        r2 = self.has_ref_section(rev.text)
+        if self.added_ref_section(rev):
+            rev.add_points(self.points, 'refsection', _('added reference section'))
+        self.tally(rev)
 
-        if not r1 and r2:
-            rev.points.append([self.points, 'refsection', _('added reference section')])
-            self.totalrefsectionsadded += 1
 
+class BonusRule(Rule):
+    """
+    Gives a bonus to the revision that brings the total amount added to an article
+    up to the limit. `amount` is the Revision attribute with the amount added by each
+    revision, like 'bytes' or 'words'.
 
-class ByteBonusRule(Rule):
+    The revision reaching the limit is found once for each article, by going through
+    its revisions when the first one is tested, and looked up for the rest.
+    """
 
-    def __init__(self, key, points, limit):
+    state = ('crossings',)
+
+    def __init__(self, key, points, limit, amount):
         Rule.__init__(self, key)
         self.points = float(points)
         self.limit = int(limit)
+        self.amount = amount
+        self.crossings = {}   # article -> id of the revision reaching the limit, or None
+
+    def get_amount(self, rev):
+        return getattr(rev, self.amount)
+
+    def get_crossing(self, rev):
+        article = rev.article
+        akey = (article.user.name, article.site.key, article.name)
+        if rev.revid == article.revisions.firstkey() or not akey in self.crossings:
+            total = 0
+            self.crossings[akey] = None
+            for r in article.revisions.itervalues():
+                amount = self.get_amount(r)
+                if amount > 0:
+                    total += amount
+                if total >= self.limit:
+                    self.crossings[akey] = r.revid
+                    break
+        return self.crossings[akey]
+
+    def tally(self, rev):
+        # Keeps the revision reaching the limit up to date when the first revisions
+        # of an article are not tested
+        self.get_crossing(rev)
+
+
+class ByteBonusRule(BonusRule):
+
+    def __init__(self, key, points, limit):
+        BonusRule.__init__(self, key, points, limit, 'bytes')
 
     def test(self, rev):
-        abytes = 0
-        thisrev = False
-        passedlimit = False
-        for r in rev.article.revisions.itervalues():
-            if r.bytes > 0:
-                abytes += r.bytes
-            if passedlimit is False and abytes >= self.limit:
-                passedlimit = True
-                if r == rev:
-                    thisrev = True
+        if self.get_crossing(rev) == rev.revid:
+            rev.add_points(self.points, 'bytebonus', _('bonus %(bytes).f bytes') % {'bytes': self.limit})
 
-        if abytes >= self.limit and thisrev is True:
-            rev.points.append([self.points, 'bytebonus', _('bonus %(bytes).f bytes') % {'bytes': self.limit}])
 
+class WordBonusRule(BonusRule):
 
-class WordBonusRule(Rule):
+    needs = ('text', 'parenttext')
+    features = ('words',)
 
     def __init__(self, key, points, limit):
-        Rule.__init__(self, key)
-        self.points = float(points)
-        self.limit = int(limit)
+        BonusRule.__init__(self, key, points, limit, 'words')
 
     def test(self, rev):
-
-        # First check all revisions
-        awords = 0
-        thisrev = False
-        passedlimit = False
-        for r in rev.article.revisions.itervalues():
-            if r.words > 0:
-                awords += r.words
-
-            if passedlimit is False and awords >= self.limit:
-                passedlimit = True
-                if r == rev:
-                    thisrev = True
-
-        if awords >= self.limit and thisrev is True:
-            rev.points.append([self.points, 'wordbonus',
-                              _('bonus %(words)d words') % {'words': self.limit}])
+        if self.get_crossing(rev) == rev.revid:
+            rev.add_points(self.points, 'wordbonus',
+                          _('bonus %(words)d words') % {'words': self.limit})
@@ -6,3 +6,7 @@ if [ ! -f "$DIR/uk.db" ]; then
 else
     echo "uk.db already exists"
 fi
+
+# Apply schema changes not yet recorded in the schemachanges table.
+# The bot also does this itself at startup.
+python "$DIR/../bot/ukdb.py" "$DIR/uk.db"
@@ -0,0 +1,9 @@
+CREATE TABLE watermarks (
+  contest TEXT NOT NULL,
+  user TEXT NOT NULL,
+  site TEXT NOT NULL,
+  revid INTEGER NOT NULL,
+  timestamp INTEGER NOT NULL,
+  fullsync INTEGER NOT NULL,
+  PRIMARY KEY(contest, user, site)
+);
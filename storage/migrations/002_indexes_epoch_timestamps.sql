@@ -0,0 +1,30 @@
+-- Store contribution timestamps as integer epoch seconds (UTC) rather than
+-- 'YYYY-MM-DD HH:MM:SS' strings, and index the columns the queries filter on.
+-- SQLite can't change the type of a column, so the table is rebuilt.
+CREATE TABLE contribs_new (
+  revid INTEGER NOT NULL,
+  site TEXT NOT NULL,
+  parentid INTEGER NOT NULL,
+  user TEXT NOT NULL,
+  page TEXT NOT NULL,
+  timestamp INTEGER NOT NULL,
+  size  INTEGER NOT NULL,
+  parentsize  INTEGER NOT NULL,
+  PRIMARY KEY(revid, site)
+);
+INSERT INTO contribs_new (revid, site, parentid, user, page, timestamp, size, parentsize)
+  SELECT revid, site, parentid, user, page,
+         CASE WHEN typeof(timestamp) = 'text' THEN CAST(strftime('%s', timestamp) AS INTEGER) ELSE timestamp END,
+         size, parentsize
+  FROM contribs;
+DROP TABLE contribs;
+ALTER TABLE contribs_new RENAME TO contribs;
+
+-- Covers User.add_contribs_from_db, which reads a user's contributions in a time range
+CREATE INDEX contribs_user_timestamp ON contribs (user, timestamp, site, revid, parentid, size, parentsize, page);
+
+-- Covers UK.delete_contribs_from_db, which reads and deletes contributions in a time range
+CREATE INDEX contribs_timestamp ON contribs (timestamp, site, revid, parentid);
+
+-- Covers the lookups in UK.deliver_warnings
+CREATE INDEX notifications_lookup ON notifications (contest, user, class, args);
@@ -0,0 +1,3 @@
+-- How revtxt is stored, see TEXT_PLAIN and TEXT_ZLIB in bot/ukdb.py.
+-- Existing rows are plain text.
+ALTER TABLE fulltexts ADD COLUMN format INTEGER NOT NULL DEFAULT 0;
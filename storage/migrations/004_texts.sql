@@ -0,0 +1,26 @@
+-- Store each distinct text once in the texts table, keyed by the SHA-1 of the
+-- UTF-8 encoded text, and let fulltexts map revisions to text hashes.
+-- size is the length of the text in bytes, so that it can be known without
+-- decompressing the content. text_hash() and text_size() are defined by
+-- ukdb.migrate.
+CREATE TABLE texts (
+  hash TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  format INTEGER NOT NULL,
+  content BLOB NOT NULL,
+  PRIMARY KEY(hash)
+);
+CREATE TABLE fulltexts_new (
+  revid INTEGER NOT NULL,
+  site TEXT NOT NULL,
+  hash TEXT NOT NULL,
+  PRIMARY KEY(revid, site)
+);
+INSERT INTO fulltexts_new (revid, site, hash)
+  SELECT revid, site, text_hash(format, revtxt) FROM fulltexts;
+INSERT OR IGNORE INTO texts (hash, size, format, content)
+  SELECT n.hash, text_size(f.format, f.revtxt), f.format, f.revtxt
+  FROM fulltexts_new AS n
+  JOIN fulltexts AS f ON f.revid = n.revid AND f.site = n.site;
+DROP TABLE fulltexts;
+ALTER TABLE fulltexts_new RENAME TO fulltexts;
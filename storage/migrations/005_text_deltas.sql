@@ -0,0 +1,5 @@
+-- Texts can be stored as deltas against the text of the parent revision, see
+-- TextStore in bot/ukdb.py. base is the hash of that text, and depth is the
+-- number of deltas to apply to rebuild the text. Full texts have depth 0.
+ALTER TABLE texts ADD COLUMN base TEXT;
+ALTER TABLE texts ADD COLUMN depth INTEGER NOT NULL DEFAULT 0;
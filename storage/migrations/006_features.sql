@@ -0,0 +1,10 @@
+-- Counts derived from revision texts, see bot/ukfeatures.py. hash is the hash
+-- of the text in the texts table, and value is JSON. Values with a version
+-- other than the current version of the extractor are computed again.
+CREATE TABLE features (
+  hash TEXT NOT NULL,
+  name TEXT NOT NULL,
+  version INTEGER NOT NULL,
+  value TEXT NOT NULL,
+  PRIMARY KEY(hash, name)
+);
@@ -0,0 +1,17 @@
+-- Points given to each revision in a contest, see User.analyze in
+-- bot/ukbot.py. A revision can count in several contests under different
+-- rules, so the points are stored per contest. fingerprint identifies the rules
+-- and the state of the article they were given under, and inputs the revision
+-- data the rules look at. prevrevid is the revision before it in the article,
+-- so that the points are only reused for an unchanged chain of revisions.
+-- points is a JSON list of the entries of Revision.points.
+CREATE TABLE points (
+  contest TEXT NOT NULL,
+  site TEXT NOT NULL,
+  revid INTEGER NOT NULL,
+  fingerprint TEXT NOT NULL,
+  prevrevid INTEGER,
+  inputs TEXT NOT NULL,
+  points TEXT NOT NULL,
+  PRIMARY KEY(contest, site, revid)
+);
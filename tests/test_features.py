@@ -0,0 +1,114 @@
+#encoding=utf-8
+"""
+Counting a feature only for the lines that differ from the parent text (see
+ukfeatures.count_region) must give the same as counting the whole text.
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bot'))
+
+import ukdb
+import ukfeatures
+from ukfeatures import Document, EXTRACTORS, REGIONS, FeatureCache, count_region
+
+BASE = """{{Infoboks person
+| navn = {{{navn|Ola Nordmann}}}
+| bilde = Ola.jpg
+| født = {{Fødselsdato|1960|1|1}}
+}}
+'''Ola Nordmann''' var en [http://example.com/ola norsk] skiløper.<ref>{{Kilde www
+| url = http://example.com/a
+| tittel = A [http://example.com/b lenke] }}</ref> Han var {{{1}}} år.
+
+== Karriere ==
+Han vant <nowiki/>[[NM]] i 1990.{{Trenger kilde}}<ref name="b" />
+<nowiki>{{Ikke en mal}} [http://example.com/c c]</nowiki>
+<!-- {{Skjult}}
+[[Fil:Skjult.png]] -->
+[[Fil:Ola2.png|thumb|Ola i {{Sted|Oslo}}]]
+<pre>
+{{Kode}}
+</pre>
+
+== Kilder ==
+* {{Kilde bok|tittel=B}} [http://example.com/d d]
+{{Referanser}}
+{{Autoritetsdata}}"""
+
+
+def replace(old, new):
+    return lambda txt: txt.replace(old, new, 1)
+
+
+# Edits of the text, many of them inside or next to templates, references,
+# comments and nowiki tags spanning several lines
+EDITS = [
+    replace('| bilde = Ola.jpg', '| bilde = Ola.jpg\n| bildetekst = {{Sted|Oslo}}'),
+    replace('| navn = {{{navn|Ola Nordmann}}}', '| navn = {{{navn|{{PAGENAME}}}}}'),
+    replace('Han var {{{1}}} år.', 'Han var {{{1|{{Alder|1960}}}}} år. [[Fil:Ny.png]]'),
+    replace('| url = http://example.com/a', '| url = http://example.com/a\n| verk = {{Avis|VG}}'),
+    replace('| tittel = A [http://example.com/b lenke] }}</ref>', '| tittel = A }}</ref>'),
+    replace('Han vant <nowiki/>[[NM]]', 'Han vant <nowiki/>{{Flagg|NOR}} [[NM]]'),
+    replace('<nowiki/>', ''),
+    replace('[[NM]] i 1990.', '[[NM]] i 1990 <nowiki>'),
+    replace('<nowiki>{{Ikke en mal}}', '{{Ikke en mal}}'),
+    replace('<!-- {{Skjult}}', '{{Skjult}}'),
+    replace('[[Fil:Skjult.png]] -->', '[[Fil:Skjult.png]]'),
+    replace('[[Fil:Skjult.png]] -->', '[[Fil:Skjult.png]] --> {{Synlig}}'),
+    replace('<pre>\n{{Kode}}\n</pre>', '{{Kode}}'),
+    replace('{{Kode}}', '{{Kode}} {{Mer kode}}'),
+    replace('{{Trenger kilde}}', '{{Trenger\nkilde}}'),
+    replace('[[Fil:Ola2.png|thumb|Ola i {{Sted|Oslo}}]]', '[[Fil:Ola2.png|thumb|Ola i\n{{Sted|Oslo}}]]'),
+    replace('== Karriere ==', '== Karriere ==\n{{Uferdig\n| dato = 2026}}'),
+    replace('== Karriere ==', '== Karriere ==\n{{Uferdig'),
+    replace('== Karriere ==', '== Karriere ==\n[http://example.com/e e] [[Fil:E.svg]] {{E}}'),
+    replace('* {{Kilde bok|tittel=B}} [http://example.com/d d]', ''),
+    replace('{{Referanser}}', '<ref>{{Kilde www\n| url = http://example.com/f }}</ref>\n{{Referanser}}'),
+    replace('{{Autoritetsdata}}', '{{Autoritetsdata}}\n{{Portal|Sport}}'),
+    replace('{{Autoritetsdata}}', ''),
+    lambda txt: '{{Rydde}}\n' + txt,
+    lambda txt: txt + '\n}}',
+]
+
+
+class RegionTest(unittest.TestCase):
+
+    def pairs(self):
+        """ (base, text) pairs, with each edit both made and reverted """
+        for edit in EDITS:
+            txt = edit(BASE)
+            self.assertNotEqual(txt, BASE)
+            yield BASE, txt
+            yield txt, BASE
+
+    def test_count_region(self):
+        """ Region counts that are found equal counts of the whole text """
+        for name in sorted(REGIONS):
+            fn = EXTRACTORS[name][1]
+            nregion = 0
+            for a, b in self.pairs():
+                base, doc = Document(a), Document(b)
+                value = count_region(name, base, doc, fn(base))
+                if value is not None:
+                    nregion += 1
+                    self.assertEqual(value, fn(Document(b)), '%s for %r' % (name, b))
+            # Most edits don't need the whole text to be counted
+            self.assertGreater(nregion, len(EDITS), name)
+
+    def test_feature_cache(self):
+        """ FeatureCache gives the counts of the whole text for every extractor """
+        texts = ukdb.TextStore()
+        for a, b in self.pairs():
+            features = FeatureCache(texts)
+            ka, kb = texts.add(a), texts.add(b)
+            for name in sorted(EXTRACTORS):
+                fn = EXTRACTORS[name][1]
+                self.assertEqual(features.get(ka, name), fn(Document(a)), name)
+                self.assertEqual(features.get(kb, name, ka), fn(Document(b)), '%s for %r' % (name, b))
+
+
+if __name__ == '__main__':
+    unittest.main()
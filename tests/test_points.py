@@ -0,0 +1,206 @@
+#encoding=utf-8
+"""
+Points stored by an earlier run (see ukbot.User.analyze) must be given again exactly
+as the rules would give them, and the rules must end up with the same statistics.
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import copy
+import tempfile
+import unittest
+
+BOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bot')
+sys.path.insert(0, BOT)
+
+# ukbot reads its arguments and config when imported
+CONFIG = tempfile.NamedTemporaryFile(suffix='.yml', delete=False)
+CONFIG.write(b'locale: [C]\nserver_timezone: UTC\nwiki_timezone: Europe/Oslo\n')
+CONFIG.close()
+argv = sys.argv
+sys.argv = ['ukbot.py', '--config', CONFIG.name]
+try:
+    import ukbot
+finally:
+    sys.argv = argv
+    os.unlink(CONFIG.name)
+
+import ukdb
+import ukfeatures
+from ukrules import (NewPageRule, RedirectRule, QualiRule, ByteRule, WordRule, ImageRule,
+                     ExternalLinkRule, RefRule, RefSectionFiRule, TemplateRemovalRule,
+                     ByteBonusRule, WordBonusRule)
+
+T0 = 1791756000
+
+# (revid, page, text) for the revisions of the user, in order
+REVISIONS = [
+    (101, 'Ola Nordmann', "{{Opprydning}}\n'''Ola Nordmann''' er en norsk skiløper."),
+    (102, 'Kari Nordmann', "'''Kari Nordmann''' er en langrennsløper fra Oslo.<ref>Aftenposten, 2001</ref>\n"
+                           "[[Fil:Kari.jpg|thumb]]"),
+    (103, 'Ola Nordmann', "{{Opprydning}}\n'''Ola Nordmann''' er en norsk skiløper.\n"
+                          "Han vant [[NM]] i 1990 og 1991 med god margin.<ref name=\"nm\">NM-resultater</ref>\n"
+                          "[http://example.com/ola Offisiell side]"),
+    (104, 'Ola Nordmann', "'''Ola Nordmann''' er en norsk skiløper fra Lillehammer.\n"
+                          "Han vant [[NM]] i 1990 og 1991 med god margin.<ref name=\"nm\">NM-resultater</ref>\n"
+                          "Han ble nummer tre i VM i 1993.<ref name=\"nm\" />\n"
+                          "[[Fil:Ola.png|thumb|Ola i 1993]]\n"
+                          "[http://example.com/ola Offisiell side] [http://example.com/vm VM]"),
+    (105, 'Nordmann, Ola', "#OMDIRIGERING [[Ola Nordmann]]"),
+    (106, 'Kari Nordmann', "{{Rydde opp}}\n'''Kari Nordmann''' er en langrennsløper fra Oslo.<ref>Aftenposten, 2001</ref>\n"
+                           "Hun gikk for Bækkelagets SK og vant flere kretsmesterskap.\n"
+                           "[[Fil:Kari.jpg|thumb]]\n"
+                           "== Kilder ==\n* Norsk idrettsleksikon\n* Skisport, 1999"),
+    (107, 'Matti Meikäläinen', "'''Matti Meikäläinen''' on suomalainen hiihtäjä.\n"
+                               "== Lähteet ==\n{{Viitteet}}"),
+    (108, 'Ola Nordmann', "'''Ola Nordmann''' er en norsk skiløper fra Lillehammer.\n"
+                          "Han vant [[NM]] i 1990 og 1991 med god margin.<ref name=\"nm\">NM-resultater</ref>\n"
+                          "Han ble nummer tre i VM i 1993.<ref name=\"nm\" />\n"
+                          "Etter karrieren ble han trener for landslaget, og senere sportssjef i "
+                          "Norges Skiforbund. Han er kjent for å ha innført høydetrening for "
+                          "juniorene, og for sitt arbeid med rekruttering i små klubber.<ref>Skisport, 2010</ref>\n"
+                          "[[Fil:Ola.png|thumb|Ola i 1993]]\n[[Fil:Trener.jpg]]\n"
+                          "[http://example.com/ola Offisiell side] [http://example.com/vm VM]"),
+    (109, 'Kari Nordmann', "'''Kari Nordmann''' er en langrennsløper fra Oslo.<ref>Aftenposten, 2001</ref>\n"
+                           "[[Fil:Kari.jpg|thumb]]\n"
+                           "== Kilder ==\n* Norsk idrettsleksikon\n* Skisport, 1999"),
+    (110, 'Ola Nordmann', "'''Ola Nordmann''' er en norsk skiløper fra Lillehammer.\n"
+                          "Han vant [[NM]] i 1990 og 1991 med god margin.<ref name=\"nm\">NM-resultater</ref>\n"
+                          "Han ble nummer tre i VM i 1993.<ref name=\"nm\" />\n"
+                          "Etter karrieren ble han trener for landslaget, og senere sportssjef i "
+                          "Norges Skiforbund. Han er kjent for å ha innført høydetrening for "
+                          "juniorene, og for sitt arbeid med rekruttering i små klubber.<ref>Skisport, 2010</ref>\n"
+                          "Han bor i dag på Hamar med familien sin.\n"
+                          "[[Fil:Ola.png|thumb|Ola i 1993]]\n[[Fil:Trener.jpg]]\n"
+                          "[http://example.com/ola Offisiell side] [http://example.com/vm VM]"),
+]
+
+
+def make_rules(bytepoints=0.1, wordmax=40, bytelimit=300, template='Opprydning'):
+    return [
+        NewPageRule('newpage', 10),
+        RedirectRule('redirect', 1),
+        QualiRule('qualified', 2),
+        ByteRule('byte', bytepoints, 25),
+        WordRule('word', 1, wordmax),
+        ImageRule('image', 3),
+        ExternalLinkRule('extlink', 1, 3),
+        RefRule('ref', 2, 1),
+        RefSectionFiRule('refsectionfi', 4),
+        TemplateRemovalRule('templateremoval', 5, template, ['Rydde*']),
+        ByteBonusRule('bytebonus', 20, bytelimit),
+        WordBonusRule('wordbonus', 15, 50),
+    ]
+
+
+class Site(object):
+    key = 'no'
+    host = 'no.wikipedia.org'
+
+
+class Contest(object):
+    """ The parts of ukbot.UK that User.analyze uses """
+
+    def __init__(self, name, rules, sql):
+        self.name = name
+        self.rules = rules
+        self.sql = sql
+        self.verbose = False
+        self.texts = ukdb.TextStore()
+        self.features = ukfeatures.FeatureCache(self.texts)
+        self.rules_fingerprint = ukbot.get_rules_fingerprint(rules, ['nb_NO'])
+        self.pool_features = set()
+
+    def get_sql(self):
+        return self.sql
+
+
+def make_db():
+    sql = ukdb.connect(':memory:')
+    sql.executescript(open(os.path.join(ukdb.STORAGE, 'baseline.sql')).read())
+    ukdb.migrate(sql)
+    return sql
+
+
+def analyze(sql, contest_name, rules, revisions=REVISIONS):
+    """ Gives points to the revisions and returns the points of each revision and the state of the rules """
+    contest = Contest(contest_name, rules, sql)
+    user = ukbot.User('Testbruker', contest)
+    site = Site()
+    last = {}
+    for revid, page, txt in revisions:
+        article = user.add_article_if_necessary(site, page)
+        parent = last.get(page)
+        rev = article.add_revision(revid, timestamp=T0 + revid * 600, size=len(txt.encode('utf-8')),
+                                   parentid=0 if parent is None else parent.revid,
+                                   parentsize=0 if parent is None else parent.size)
+        rev.text = txt
+        if parent is not None:
+            rev.parenthash = parent.texthash
+        last[page] = rev
+    user.analyze(rules)
+    points = [(revid, [list(p) for p in user.revisions[revid].points]) for revid, page, txt in revisions]
+    state = [(type(r).__name__, [(k, getattr(r, k)) for k in r.state]) for r in rules]
+    return points, state, list(user.timeline.total)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_replay(self):
+        """ All points are given again from the DB, with the rules in the same state """
+        sql = make_db()
+        fresh = analyze(sql, 'A', make_rules())
+        self.assertTrue(all([len(p) > 0 for revid, p in fresh[0]]))
+        changes = sql.total_changes
+        replay = analyze(sql, 'A', make_rules())
+        self.assertEqual(sql.total_changes, changes)   # nothing new was stored
+        self.assertEqual(replay, fresh)
+
+    def test_partial_replay(self):
+        """ Points are given again for unchanged revisions, and the rules tested for the rest """
+        edited = [(revid, page, txt.replace('1991', '1992')) if revid == 104 else (revid, page, txt)
+                  for revid, page, txt in REVISIONS]
+        for first, second in [(REVISIONS[:7], REVISIONS), (REVISIONS, edited)]:
+            sql = make_db()
+            analyze(sql, 'A', make_rules(), first)
+            replay = analyze(sql, 'A', make_rules(), second)
+            self.assertEqual(replay, analyze(make_db(), 'A', make_rules(), second))
+
+    def test_changed_rules(self):
+        """ Stored points are not given again when a rule parameter has changed """
+        for params in [{'bytepoints': 0.2}, {'wordmax': 10}, {'bytelimit': 200}, {'template': 'Rydde opp'}]:
+            sql = make_db()
+            before = analyze(sql, 'A', make_rules())
+            after = analyze(sql, 'A', make_rules(**params))
+            self.assertNotEqual(after, before, params)
+            self.assertEqual(after, analyze(make_db(), 'A', make_rules(**params)), params)
+
+    def test_fingerprint(self):
+        """ The fingerprint of a rule changes with each of its parameters, but not with its state """
+        for rule in make_rules():
+            for k, v in vars(rule).items():
+                changed = copy.deepcopy(rule)
+                if isinstance(v, basestring):
+                    setattr(changed, k, v + 'x')
+                elif isinstance(v, (list, dict)):
+                    setattr(changed, k, v + ['x'] if isinstance(v, list) else {'x': 1})
+                else:
+                    setattr(changed, k, v + 1)
+                if k in rule.state:
+                    self.assertEqual(changed.get_fingerprint(), rule.get_fingerprint(), k)
+                else:
+                    self.assertNotEqual(changed.get_fingerprint(), rule.get_fingerprint(), k)
+
+    def test_contests(self):
+        """ Points are stored per contest, so contests with different rules don't share them """
+        sql = make_db()
+        a = analyze(sql, 'A', make_rules())
+        b = analyze(sql, 'B', make_rules(bytepoints=0.2))
+        self.assertEqual(b, analyze(make_db(), 'B', make_rules(bytepoints=0.2)))
+        changes = sql.total_changes
+        self.assertEqual(analyze(sql, 'A', make_rules()), a)
+        self.assertEqual(sql.total_changes, changes)
+
+
+if __name__ == '__main__':
+    unittest.main()